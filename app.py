@@ -1,8 +1,27 @@
 import streamlit as st
-import pymongo 
 import os
-from pymongo import MongoClient
-import google.generativeai as genai
+import atexit
+import hashlib
+import hmac
+import heapq
+import itertools
+import json
+import logging
+import queue
+import random
+import re
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId, json_util
+from bson.errors import InvalidId
+# pymongo / google.generativeai ถูก import ตอนใช้งานจริงเท่านั้น (หน้า login ไม่ต้องโหลด SDK ทำให้ cold start เร็ว)
 
 # ==============================================================================
 # 1. CONFIGURATION & SETUP
@@ -15,10 +34,27 @@ GVCCCM_DATABASE_NAME = 'GVCCCM'
 GVCCCM_STEP_COLLECTION = 'Step'
 GVCCCM_SCORE_COLLECTION = 'Score'
 LOG_COLLECTION_NAME = 'practice_logs'
+EVAL_CACHE_COLLECTION_NAME = 'evaluation_cache'
+REGRADE_JOB_COLLECTION_NAME = 'regrade_jobs'
+SESSION_COLLECTION_NAME = 'practice_sessions'
+TURN_COLLECTION_NAME = 'practice_turns'
+
+# สถานะผู้ใช้ที่เข้าหน้าอาจารย์ได้
+INSTRUCTOR_ROLE = 'อาจารย์'
+
+# ทิศทางการเรียงของ index / sort (ค่าเดียวกับ pymongo.ASCENDING / DESCENDING)
+ASCENDING = 1
+DESCENDING = -1
 
 # *** แก้ชื่อโมเดลให้ถูกต้อง (แนะนำ 1.5-flash เพื่อความชัวร์) ***
 MODEL_NAME = 'gemini-2.5-flash'
 
+# โหมดตอบแชทแบบ Streaming (ทยอยแสดงคำตอบ) ปิดได้ด้วย CHAT_STREAMING=0
+CHAT_STREAMING_DEFAULT = os.environ.get("CHAT_STREAMING", "1") != "0"
+
+# โหมดจัดการ context ของแชท: 'bounded' (จำกัด token + สรุปบทสนทนาเก่า) หรือ 'full' (ส่งประวัติทั้งหมด)
+CHAT_CONTEXT_MODE = os.environ.get("CHAT_CONTEXT_MODE", "bounded")
+
 # --- ฟังก์ชันช่วยดึงค่า Key (แก้ใหม่ให้รองรับ section) ---
 def get_secret(key, section=None):
     """
@@ -40,6 +76,14 @@ def get_secret(key, section=None):
     except (FileNotFoundError, KeyError):
         return None
 
+def get_int_secret(key, default, section=None):
+    """ดึงค่า Secret ที่เป็นตัวเลข ถ้าไม่ได้ตั้งไว้หรือแปลงไม่ได้ให้ใช้ค่า default"""
+    value = get_secret(key, section=section)
+    try:
+        return int(value) if value not in (None, "") else default
+    except (TypeError, ValueError):
+        return default
+
 # เรียกใช้ฟังก์ชัน (Render ใช้ชื่อ GEMINI_API_KEY ตรงๆ)
 api_key = get_secret("GEMINI_API_KEY")
 
@@ -48,45 +92,375 @@ if not api_key:
     st.error("🚨 ไม่พบ API Key! กรุณาตั้งค่า 'GEMINI_API_KEY' ใน Render Environment Variables")
     st.stop()
 
-# ตั้งค่า Gemini
-genai.configure(api_key=api_key)
+# ตั้งค่า Gemini (import SDK + configure ครั้งแรกที่เรียกใช้)
+@st.cache_resource(show_spinner=False)
+def gemini():
+    import google.generativeai as genai
+    genai.configure(api_key=api_key)
+    return genai
+
+# --- Instrumentation: latency / token / error metrics ของ Gemini และ Mongo ---
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+METRICS_JSON_LOGS = get_secret("METRICS_JSON_LOGS") == "1"   # log JSON ทุก call ลง stdout
+METRICS_PORT = get_int_secret("METRICS_PORT", 0)              # >0 = เปิด endpoint /metrics แยก port
+
+metrics_logger = logging.getLogger("vet_app.metrics")
+if METRICS_JSON_LOGS and not metrics_logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    metrics_logger.addHandler(_handler)
+    metrics_logger.setLevel(logging.INFO)
+    metrics_logger.propagate = False
+
+
+class MetricsRegistry:
+    """เก็บ counter / histogram แบบ Prometheus (ใช้ร่วมกันทั้ง process)"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._counters = {}    # (name, labels) -> ค่า
+        self._histograms = {}  # (name, labels) -> [จำนวนในแต่ละ bucket, sum, count]
+
+    def inc(self, name, labels=None, value=1):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, labels=None):
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self._lock:
+            hist = self._histograms.setdefault(key, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    hist[0][i] += 1
+            hist[1] += value
+            hist[2] += 1
+
+    def render_prometheus(self, gauges=None):
+        """ส่งออกเป็น Prometheus text exposition format"""
+        def fmt(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs: return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+        lines = []
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items())
+        for (name, labels), value in counters:
+            lines.append(f"{name}{fmt(labels)} {value}")
+        for (name, labels), (bucket_counts, total, count) in histograms:
+            for bound, n in zip(self.buckets, bucket_counts):
+                lines.append(f"{name}_bucket{fmt(labels, [('le', bound)])} {n}")
+            lines.append(f"{name}_bucket{fmt(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{fmt(labels)} {total}")
+            lines.append(f"{name}_count{fmt(labels)} {count}")
+        for name, value in sorted((gauges or {}).items()):
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """สรุป latency (count / avg / p95 โดยประมาณจาก bucket) สำหรับหน้า admin"""
+        rows = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+        for (name, labels), (bucket_counts, total, count) in histograms:
+            p95 = next((b for b, n in zip(self.buckets, bucket_counts) if n >= 0.95 * count), float("inf"))
+            rows.append({
+                "metric": name,
+                "labels": ",".join(f"{k}={v}" for k, v in labels),
+                "count": count,
+                "avg_ms": round(total / count * 1000, 1) if count else 0.0,
+                "p95_ms_le": p95 * 1000,
+            })
+        return rows
+
+
+class MongoCommandMetrics:
+    """จับเวลาทุกคำสั่ง Mongo (find / insert / aggregate ...) ผ่าน pymongo command monitoring"""
+
+    def __init__(self, registry):
+        self.registry = registry
+
+    def started(self, event): pass
+
+    def succeeded(self, event):
+        seconds = event.duration_micros / 1e6
+        self.registry.observe("vet_app_mongo_command_seconds", seconds, {"command": event.command_name})
+        log_call_event("mongo", event.command_name, seconds, True)
+
+    def failed(self, event):
+        seconds = event.duration_micros / 1e6
+        self.registry.observe("vet_app_mongo_command_seconds", seconds, {"command": event.command_name})
+        self.registry.inc("vet_app_mongo_errors_total", {"command": event.command_name})
+        log_call_event("mongo", event.command_name, seconds, False)
+
+
+@st.cache_resource(show_spinner=False)
+def get_metrics():
+    """metrics registry ตัวเดียวของทั้ง process"""
+    return MetricsRegistry(METRICS_LATENCY_BUCKETS)
+
+def log_call_event(kind, op, seconds, ok, **fields):
+    """เขียน structured JSON log หนึ่งบรรทัดต่อ call (เปิดด้วย METRICS_JSON_LOGS=1)"""
+    if not METRICS_JSON_LOGS: return
+    record = {"ts": datetime.now(timezone.utc).isoformat(), "kind": kind, "op": op,
+              "latency_ms": round(seconds * 1000, 2), "ok": ok}
+    record.update(fields)
+    metrics_logger.info(json.dumps(record, ensure_ascii=False))
+
+def _record_gemini_usage(op, response):
+    """นับ token จาก usage_metadata ของคำตอบ Gemini คืน dict จำนวน token"""
+    usage = getattr(response, "usage_metadata", None)
+    if not usage: return {}
+    tokens = {
+        "prompt_tokens": getattr(usage, "prompt_token_count", 0) or 0,
+        "response_tokens": getattr(usage, "candidates_token_count", 0) or 0,
+    }
+    registry = get_metrics()
+    registry.inc("vet_app_gemini_tokens_total", {"op": op, "type": "prompt"}, tokens["prompt_tokens"])
+    registry.inc("vet_app_gemini_tokens_total", {"op": op, "type": "response"}, tokens["response_tokens"])
+    return tokens
+
+@contextmanager
+def instrument(kind, op):
+    """
+    context manager จับเวลา + นับ error ของ call ภายนอก
+    ใส่ response ลงใน call["response"] เพื่อให้นับ token จาก usage_metadata ด้วย
+    """
+    registry = get_metrics()
+    call = {"response": None}
+    started = time.perf_counter()
+    try:
+        yield call
+    except Exception:
+        seconds = time.perf_counter() - started
+        registry.inc(f"vet_app_{kind}_errors_total", {"op": op})
+        registry.observe(f"vet_app_{kind}_request_seconds", seconds, {"op": op})
+        log_call_event(kind, op, seconds, False)
+        raise
+    seconds = time.perf_counter() - started
+    registry.observe(f"vet_app_{kind}_request_seconds", seconds, {"op": op})
+    tokens = _record_gemini_usage(op, call["response"]) if call["response"] is not None else {}
+    log_call_event(kind, op, seconds, True, **tokens)
+
+def _instrumented_stream(op, response, started):
+    registry = get_metrics()
+    first_token = None
+    try:
+        for chunk in response:
+            if first_token is None:
+                first_token = time.perf_counter() - started
+                registry.observe("vet_app_gemini_first_token_seconds", first_token, {"op": op})
+            yield chunk
+    except Exception:
+        registry.inc("vet_app_gemini_errors_total", {"op": op})
+        log_call_event("gemini", op, time.perf_counter() - started, False, stream=True)
+        raise
+    seconds = time.perf_counter() - started
+    registry.observe("vet_app_gemini_request_seconds", seconds, {"op": op})
+    tokens = _record_gemini_usage(op, response)
+    log_call_event("gemini", op, seconds, True, stream=True, **tokens)
+
+def _call_gemini_once(op, request, stream=False):
+    """
+    เรียก Gemini หนึ่งครั้งผ่าน request() พร้อมเก็บ metrics
+    stream=True จะคืน generator ของ chunk ที่จับเวลา token แรกและเวลารวมให้
+    """
+    if not stream:
+        with instrument("gemini", op) as call:
+            call["response"] = request()
+        return call["response"]
+    started = time.perf_counter()
+    with instrument("gemini", f"{op}_connect"):
+        response = request()
+    return _instrumented_stream(op, response, started)
+
+
+class _MetricsHTTPHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = collect_metrics_text().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@st.cache_resource(show_spinner=False)
+def start_metrics_server(port):
+    """เปิด HTTP endpoint /metrics (Prometheus scrape) บน thread เบื้องหลัง"""
+    server = ThreadingHTTPServer(("0.0.0.0", port), _MetricsHTTPHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True).start()
+    return server
 
 # ==============================================================================
 # 2. MONGODB FUNCTIONS
 # ==============================================================================
 
-@st.cache_data(ttl=3600)
+# --- ตั้งค่า Connection Pool (ปรับได้ผ่าน Environment Variable หรือ section mongo) ---
+MONGO_POOL_SETTINGS = {
+    "maxPoolSize": get_int_secret("MONGO_MAX_POOL_SIZE", 50, section="mongo"),
+    "minPoolSize": get_int_secret("MONGO_MIN_POOL_SIZE", 0, section="mongo"),
+    "maxIdleTimeMS": get_int_secret("MONGO_MAX_IDLE_TIME_MS", 300000, section="mongo"),
+    "waitQueueTimeoutMS": get_int_secret("MONGO_WAIT_QUEUE_TIMEOUT_MS", 10000, section="mongo"),
+    "serverSelectionTimeoutMS": get_int_secret("MONGO_SERVER_SELECTION_TIMEOUT_MS", 5000, section="mongo"),
+    "connectTimeoutMS": get_int_secret("MONGO_CONNECT_TIMEOUT_MS", 5000, section="mongo"),
+    "socketTimeoutMS": get_int_secret("MONGO_SOCKET_TIMEOUT_MS", 20000, section="mongo"),
+    "retryWrites": True,
+    "retryReads": True,
+}
+# ตรวจสุขภาพ client (ping บน thread เบื้องหลัง) ทุกกี่วินาที
+MONGO_HEALTH_CHECK_INTERVAL = get_int_secret("MONGO_HEALTH_CHECK_INTERVAL", 30, section="mongo")
+
+
+class MongoPoolStats:
+    """เก็บสถิติ Connection Pool: จำนวนครั้งที่ใช้ connection ซ้ำ และเวลารอ checkout"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._checkout_started = {}  # thread id -> เวลาที่เริ่มขอ connection
+        self.clients_created = 0
+        self.healthy = True
+        self.health_check_failures = 0
+        self.connections_created = 0
+        self.connections_closed = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.checkout_wait_total = 0.0
+        self.checkout_wait_max = 0.0
+
+    # --- Pool events (ไม่ต้องเก็บอะไร แต่ต้องมีให้ครบตาม interface) ---
+    def pool_created(self, event): pass
+    def pool_ready(self, event): pass
+    def pool_cleared(self, event): pass
+    def pool_closed(self, event): pass
+    def connection_ready(self, event): pass
+    def connection_checked_in(self, event): pass
+
+    def connection_created(self, event):
+        with self._lock:
+            self.connections_created += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.connections_closed += 1
+
+    def connection_check_out_started(self, event):
+        self._checkout_started[threading.get_ident()] = time.perf_counter()
+
+    def connection_check_out_failed(self, event):
+        self._checkout_started.pop(threading.get_ident(), None)
+        with self._lock:
+            self.checkout_failures += 1
+
+    def connection_checked_out(self, event):
+        started = self._checkout_started.pop(threading.get_ident(), None)
+        wait = time.perf_counter() - started if started is not None else 0.0
+        with self._lock:
+            self.checkouts += 1
+            self.checkout_wait_total += wait
+            self.checkout_wait_max = max(self.checkout_wait_max, wait)
+
+    def snapshot(self):
+        """คืนค่าสถิติปัจจุบันเป็น dict (ใช้แสดงผล / ส่งออก metrics)"""
+        with self._lock:
+            reused = max(self.checkouts - self.connections_created, 0)
+            return {
+                "clients_created": self.clients_created,
+                "healthy": int(self.healthy),
+                "health_check_failures": self.health_check_failures,
+                "connections_created": self.connections_created,
+                "connections_closed": self.connections_closed,
+                "checkouts": self.checkouts,
+                "checkouts_reused": reused,
+                "reuse_ratio": (reused / self.checkouts) if self.checkouts else 0.0,
+                "checkout_failures": self.checkout_failures,
+                "checkout_wait_avg_ms": (self.checkout_wait_total / self.checkouts * 1000) if self.checkouts else 0.0,
+                "checkout_wait_max_ms": self.checkout_wait_max * 1000,
+            }
+
+
+def _pymongo_listener(cls, base_name, *args):
+    """
+    สร้าง listener ของ pymongo จากคลาสธรรมดา โดยผูก base class (monitoring.<base_name>) ตอนสร้าง
+    คลาสใน app.py จึงไม่ต้อง import pymongo ตอนโหลด script
+    """
+    from pymongo import monitoring
+    return type(cls.__name__, (cls, getattr(monitoring, base_name)), {})(*args)
+
+@st.cache_resource(show_spinner=False)
+def get_pool_stats():
+    """ตัวนับสถิติ Pool ตัวเดียวของทั้ง process"""
+    return _pymongo_listener(MongoPoolStats, "ConnectionPoolListener")
+
+@st.cache_resource(show_spinner=False)
+def _create_mongo_client(mongo_uri):
+    """สร้าง MongoClient (เรียกครั้งเดียวต่อ process ผ่าน st.cache_resource)"""
+    from pymongo import MongoClient
+
+    stats = get_pool_stats()
+    stats.clients_created += 1
+    listeners = [stats, _pymongo_listener(MongoCommandMetrics, "CommandListener", get_metrics())]
+    client = MongoClient(mongo_uri, event_listeners=listeners, **MONGO_POOL_SETTINGS)
+    threading.Thread(
+        target=_health_check_loop, args=(client, stats), name="mongo-health-check", daemon=True
+    ).start()
+    return client
+
+def _health_check_loop(client, stats):
+    """
+    ping เป็นระยะเพื่อรายงานสถานะ (ไม่บล็อกหน้าเว็บ)
+    ไม่ปิด/สร้าง client ใหม่เอง: pymongo reconnect ให้อัตโนมัติ และ client ถูกแชร์ทุก thread
+    """
+    while True:
+        time.sleep(MONGO_HEALTH_CHECK_INTERVAL)
+        try:
+            client.admin.command("ping")
+            stats.healthy = True
+        except Exception:
+            stats.healthy = False
+            stats.health_check_failures += 1
+
+def get_mongo_client():
+    """
+    คืน MongoClient ที่ใช้ร่วมกันทั้ง process (สร้างตอนเรียกใช้ครั้งแรก)
+    - ห้าม close() เอง เพราะ client ตัวนี้ถูกแชร์ทุก session / thread เบื้องหลัง
+    """
+    mongo_uri = get_secret("MONGODB_URI", section="mongo")
+    if not mongo_uri: return None
+    return _create_mongo_client(mongo_uri)
+
 def fetch_gvcccm_data():
-    """ดึงข้อมูลขั้นตอน GVCCCM (Step)"""
-    client = None
+    """ดึงข้อมูลขั้นตอน GVCCCM (Step) ตรงจาก Mongo (cache อยู่ที่ชั้น CompiledContexts)"""
     try:
-        # เรียกใช้แบบระบุ section ได้แล้ว เพราะแก้ฟังก์ชัน get_secret แล้ว
-        mongo_uri = get_secret("MONGODB_URI", section="mongo")
-        if not mongo_uri: return []
-        
-        client = MongoClient(mongo_uri)
+        client = get_mongo_client()
+        if not client: return []
+
         db = client[GVCCCM_DATABASE_NAME]
         collection = db[GVCCCM_STEP_COLLECTION]
         gvcccm_data_list = list(collection.find(
             {},
             {"_id": 0, "step_number": 1, "step_name_th": 1, "summary_detail": 1}
-        ).sort("step_number", pymongo.ASCENDING))
+        ).sort("step_number", ASCENDING))
         return gvcccm_data_list
     except Exception as e:
         st.error(f"❌ Error fetching GVCCCM steps: {e}")
         return []
-    finally:
-        if client: client.close()
 
-@st.cache_data(ttl=3600)
 def fetch_score_checklist():
-    """ดึงข้อมูล Checklist"""
-    client = None
+    """ดึงข้อมูล Checklist ตรงจาก Mongo (cache อยู่ที่ชั้น CompiledContexts)"""
     try:
-        mongo_uri = get_secret("MONGODB_URI", section="mongo")
-        if not mongo_uri: return []
+        client = get_mongo_client()
+        if not client: return []
 
-        client = MongoClient(mongo_uri)
         db = client[GVCCCM_DATABASE_NAME]
         collection = db[GVCCCM_SCORE_COLLECTION]
         checklist_data = collection.find_one({"checklist_name": "Calgary-Cambridge Consultation Communication Skills List"})
@@ -97,124 +471,2095 @@ def fetch_score_checklist():
     except Exception as e:
         st.error(f"❌ Error fetching score checklist: {e}")
         return []
-    finally:
-        if client: client.close()
 
-@st.cache_data(ttl=3600)
-def fetch_case_scenario():
-    """ดึงข้อมูลเคสจาก Mongo (เปลี่ยนชื่อฟังก์ชันให้ชัดเจนขึ้น)"""
-    client = None
+# --- Case catalogue (แบ่งหน้า + projection เฉพาะ field ที่ใช้แสดงรายการ) ---
+# collection ของเคสใน case_scenario แยกตามชนิดสัตว์ เพิ่มได้ด้วย CASE_COLLECTIONS=dog,cat
+CASE_COLLECTIONS = [c.strip() for c in (get_secret("CASE_COLLECTIONS") or "dog").split(",") if c.strip()]
+SPECIES_LABELS = {"dog": "🐶 สุนัข", "cat": "🐱 แมว"}
+CASE_PAGE_SIZE = get_int_secret("CASE_PAGE_SIZE", 12)
+CASE_SUMMARY_PROJECTION = {
+    "_id": 1,
+    "pet_name": 1,
+    "case_name": 1,
+    "owner_role.pet_name": 1,
+    "owner_role.case_name": 1,
+}
+CASE_TEXT_INDEX_FIELDS = ["case_name", "pet_name", "owner_role.pet_name", "owner_role.pet_details"]
+
+
+@st.cache_resource(show_spinner=False)
+def ensure_case_indexes(collection_name):
+    """สร้าง index ของ collection เคส (ครั้งเดียวต่อ process ต่อ collection; ถ้า error จะลองใหม่รอบหน้า)"""
+    collection = get_mongo_client()[CASE_DATABASE_NAME][collection_name]
+    # default_language none: ไม่ตัดคำ/stem (ข้อมูลส่วนใหญ่เป็นภาษาไทย)
+    collection.create_index(
+        [(field, "text") for field in CASE_TEXT_INDEX_FIELDS],
+        name="case_text_search",
+        default_language="none",
+    )
+    return True
+
+def _case_search_filter(search):
+    """เงื่อนไขค้นหาแบบ regex บนชื่อเคส/ชื่อสัตว์ (ใช้เมื่อ $text หาไม่เจอ เช่นคำไทยที่ไม่เว้นวรรค)"""
+    pattern = {"$regex": re.escape(search), "$options": "i"}
+    return {"$or": [{"case_name": pattern}, {"pet_name": pattern}, {"owner_role.pet_name": pattern}]}
+
+# --- ฟังก์ชันตัวช่วยดึงข้อมูล (แก้ปัญหา Data ซ่อนใน owner_role) ---
+def get_case_field(case, field_name, default_value="-"):
+    # 1. ลองหาที่ชั้นนอกสุดก่อน (Root Level)
+    if field_name in case:
+        return case[field_name]
+    
+    # 2. ถ้าไม่เจอ ลองมุดเข้าไปหาใน 'owner_role' (ตามรูป Database ของคุณ)
+    owner_role_obj = case.get('owner_role', {})
+    if isinstance(owner_role_obj, dict) and field_name in owner_role_obj:
+        return owner_role_obj[field_name]
+        
+    return default_value
+
+
+@dataclass(frozen=True, slots=True)
+class CaseSummary:
+    """ข้อมูลย่อของเคสสำหรับหน้ารายการ"""
+    id: str
+    collection: str
+    pet_name: str
+    case_name: str
+
+    @classmethod
+    def from_document(cls, doc, collection_name):
+        return cls(
+            id=str(doc['_id']),
+            collection=collection_name,
+            pet_name=get_case_field(doc, 'pet_name', 'ไม่ระบุชื่อ'),
+            case_name=get_case_field(doc, 'case_name', 'Case Scenario'),
+        )
+
+
+@dataclass(frozen=True, slots=True)
+class Case:
+    """
+    เคสฉบับเต็มที่ normalize แล้ว (resolve field ใน owner_role ไว้ตั้งแต่โหลดจาก Mongo)
+    instance เดียวถูกแชร์ทุก session ผ่าน st.cache_resource ห้ามแก้ไข
+    """
+    id: str
+    collection: str
+    case_name: str
+    pet_name: str
+    pet_details: str
+    role_th: str
+    personality_tone: str
+
+    @classmethod
+    def from_document(cls, doc, collection_name):
+        return cls(
+            id=str(doc['_id']),
+            collection=collection_name,
+            case_name=get_case_field(doc, 'case_name', 'Case Scenario'),
+            pet_name=get_case_field(doc, 'pet_name'),
+            pet_details=get_case_field(doc, 'pet_details'),
+            role_th=get_case_field(doc, 'role_th'),
+            personality_tone=get_case_field(doc, 'personality_tone'),
+        )
+
+    @property
+    def ref(self):
+        """ตัวอ้างอิง (collection, id) ใช้โหลดเคสซ้ำ"""
+        return (self.collection, self.id)
+
+
+# cache_resource: คืน object เดิม (ไม่ copy/pickle ทุก rerun) และผลลัพธ์เป็น tuple ของ object immutable
+# version มาจาก CacheVersions: เปลี่ยนเมื่อ collection/เอกสารถูกแก้ (ดู CacheInvalidator) จึงตั้ง TTL ได้ยาว
+@st.cache_resource(ttl=6 * 3600, max_entries=256, show_spinner=False)
+def _query_case_page(collection_name, version, page, page_size, search):
+    from pymongo.errors import OperationFailure
+
+    client = get_mongo_client()
+    if not client: raise RuntimeError("MONGODB_URI is not configured")
+    try:
+        ensure_case_indexes(collection_name)
+    except Exception:
+        pass  # ไม่มี index ก็ยังค้นด้วย regex ได้
+    collection = client[CASE_DATABASE_NAME][collection_name]
+
+    query = {}
+    if search:
+        query = {"$text": {"$search": search}}
+        try:
+            if collection.count_documents(query, limit=1) == 0:
+                query = _case_search_filter(search)
+        except OperationFailure:
+            # ยังไม่มี text index
+            query = _case_search_filter(search)
+
+    total = collection.count_documents(query)
+    cursor = (collection.find(query, CASE_SUMMARY_PROJECTION)
+              .sort("_id", ASCENDING)
+              .skip(page * page_size)
+              .limit(page_size))
+    return tuple(CaseSummary.from_document(doc, collection_name) for doc in cursor), total
+
+def fetch_case_page(collection_name, page, page_size, search=""):
+    """ดึงรายการเคสทีละหน้า (เฉพาะ field สรุป) คืน (tuple ของ CaseSummary, จำนวนทั้งหมด)"""
     try:
-        mongo_uri = get_secret("MONGODB_URI", section="mongo")
-        if not mongo_uri: return []
-
-        client = MongoClient(mongo_uri)
-        db = client.case_scenario
-        # ดึงมาแค่บางส่วนหรือทั้งหมด แปลง ObjectId เป็น str เพื่อกัน Error เวลา cache
-        items = []
-        for doc in db.dog.find():
-            doc['_id'] = str(doc['_id']) # แปลง ObjectId เป็น String
-            items.append(doc)
-        return items
+        version = get_cache_versions().get(collection_name)
+        return _query_case_page(collection_name, version, page, page_size, search)
     except Exception as e:
         # st.error(f"❌ Error fetching cases: {e}") # ปิด error ไว้ก่อนเพื่อไม่ให้รกหน้าจอถ้า connect ไม่ได้
-        return []
-    finally:
-        if client: client.close()
+        return (), 0
 
-# เรียกใช้ฟังก์ชันดึงข้อมูล (ย้ายมาไว้ใน main จะปลอดภัยกว่า แต่ประกาศตัวแปรไว้ก่อนได้)
-items = [] 
+@st.cache_resource(ttl=24 * 3600, max_entries=1024, show_spinner=False)
+def _query_case(collection_name, case_id, version):
+    client = get_mongo_client()
+    if not client: raise RuntimeError("MONGODB_URI is not configured")
+    try:
+        key = ObjectId(case_id)
+    except InvalidId:
+        key = case_id
+    doc = client[CASE_DATABASE_NAME][collection_name].find_one({"_id": key})
+    if not doc: raise LookupError(f"case {case_id} not found in {collection_name}")
+    return Case.from_document(doc, collection_name)
 
-def save_practice_log(user_info, case_info, conversation_history, feedback_text):
-    """บันทึกข้อมูลการฝึกซ้อมลง MongoDB"""
-    client = None
+def load_case(collection_name, case_id):
+    """โหลดเคสฉบับเต็ม (เรียกเมื่อเปิดหน้า case_detail เท่านั้น) คืน Case หรือ None"""
     try:
-        mongo_uri = get_secret("MONGODB_URI", section="mongo")
-        client = MongoClient(mongo_uri)
-        
-        db = client[CASE_DATABASE_NAME] 
-        collection = db[LOG_COLLECTION_NAME]
+        return _query_case(collection_name, case_id, get_cache_versions().get(collection_name, case_id))
+    except Exception as e:
+        st.error(f"❌ Error fetching case: {e}")
+        return None
+
+# --- ตั้งค่าคิวบันทึกผลแบบ write-behind ---
+LOG_JOURNAL_PATH = get_secret("PRACTICE_LOG_JOURNAL") or "practice_logs_journal.jsonl"
+LOG_WRITER_BATCH_SIZE = get_int_secret("LOG_WRITER_BATCH_SIZE", 20)
+LOG_WRITER_FLUSH_INTERVAL = 1.0      # วินาทีที่รอรวม batch
+LOG_WRITER_MAX_RETRIES = get_int_secret("LOG_WRITER_MAX_RETRIES", 4)
+LOG_WRITER_BACKOFF_BASE = 0.5        # วินาที (เพิ่มเป็นเท่าตัวทุกครั้งที่ลองใหม่)
+LOG_WRITER_BACKOFF_MAX = 8.0
+LOG_JOURNAL_REPLAY_INTERVAL = 30.0   # วินาทีระหว่างการลองส่งข้อมูลค้างใน journal
+LOG_MEMORY_BACKLOG_MAX = get_int_secret("LOG_MEMORY_BACKLOG_MAX", 5000)  # เก็บใน memory เมื่อเขียน journal ไม่ได้
+
+log_writer_logger = logging.getLogger("vet_app.practice_log_writer")
+
+
+class PracticeLogWriter:
+    """
+    คิวบันทึกข้อมูลลง MongoDB แบบไม่บล็อกหน้าเว็บ (write-behind)
+    - thread เบื้องหลังรวมเอกสารเป็น batch แล้ว insert_many
+    - ถ้า insert ไม่สำเร็จจะลองใหม่แบบ backoff
+    - ถ้ายังไม่สำเร็จจะเขียนลงไฟล์ journal (JSONL) แล้วส่งซ้ำเมื่อ Mongo กลับมา
+    - ถ้าเขียน journal ไม่ได้ (เช่น filesystem read-only) จะเก็บไว้ใน memory แทน (จำกัดจำนวน)
+    - ทุกเอกสารมี _id ที่สร้างฝั่งแอป จึงส่งซ้ำได้โดยไม่เกิดข้อมูลซ้ำ
+    """
+
+    STATUS_PENDING = "pending"
+    STATUS_SAVED = "saved"
+    STATUS_JOURNALED = "journaled"
+    STATUS_FAILED = "failed"
+    MAX_TRACKED_STATUS = 10000
+
+    def __init__(self, journal_path, batch_size, flush_interval, max_retries, on_saved=None):
+        self.journal_path = journal_path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.on_saved = on_saved      # callback(collection_name) หลังบันทึกลง Mongo สำเร็จ
+        self._queue = queue.Queue()
+        self._status = OrderedDict()  # log id -> สถานะ
+        self._status_lock = threading.Lock()
+        self._journal_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._last_replay = 0.0
+        self._backlog = []            # [(collection, document)] ที่เขียน journal ไม่ได้
+        self._thread = threading.Thread(target=self._run, name="practice-log-writer", daemon=True)
+        self._thread.start()
+
+    # --- API ฝั่งหน้าเว็บ ---
+    def submit(self, document, collection_name=LOG_COLLECTION_NAME):
+        """ใส่เอกสารเข้าคิว คืนค่า id (string) ไว้ตรวจสถานะภายหลัง"""
+        document.setdefault("_id", ObjectId())
+        log_id = str(document["_id"])
+        self._set_status([log_id], self.STATUS_PENDING)
+        self._queue.put((collection_name, document))
+        return log_id
+
+    def status(self, log_id):
+        with self._status_lock:
+            return self._status.get(log_id)
+
+    def pending_count(self):
+        return self._queue.qsize()
+
+    def close(self, timeout=5.0):
+        """หยุด thread และเขียนของที่ค้างในคิวลง journal (เรียกตอนปิดโปรแกรม)"""
+        self._stop.set()
+        self._thread.join(timeout)
+        leftovers = []
+        while True:
+            try:
+                leftovers.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if leftovers:
+            self._spill(leftovers)
+
+    # --- ทำงานใน thread เบื้องหลัง ---
+    def _run(self):
+        while not self._stop.is_set():
+            batch = []
+            try:
+                batch.append(self._queue.get(timeout=self.flush_interval))
+                while len(batch) < self.batch_size:
+                    batch.append(self._queue.get_nowait())
+            except queue.Empty:
+                pass
+
+            try:
+                recovered = bool(batch) and self._write_with_retry(batch)
+                # เพิ่งเขียนสำเร็จ (Mongo กลับมาแล้ว) หรือถึงรอบ -> ส่ง journal ซ้ำ
+                if recovered or time.monotonic() - self._last_replay >= LOG_JOURNAL_REPLAY_INTERVAL:
+                    self._last_replay = time.monotonic()
+                    self._replay_journal()
+            except Exception:
+                # ห้ามให้ thread ตาย: เก็บลง journal (หรือ memory) ไว้ก่อน
+                log_writer_logger.exception("unexpected error while writing practice logs")
+                if batch:
+                    try:
+                        self._spill(batch)
+                    except Exception:
+                        self._keep_in_memory(batch)
 
+    def _insert(self, batch):
+        """insert_many แยกตาม collection; คืนรายการที่ยังบันทึกไม่สำเร็จ"""
+        try:
+            from pymongo.errors import BulkWriteError
+            client = get_mongo_client()
+        except Exception:
+            log_writer_logger.exception("cannot get MongoDB client")
+            return batch
+        if not client:
+            return batch
+        failed = []
+        by_collection = OrderedDict()
+        for collection_name, document in batch:
+            by_collection.setdefault(collection_name, []).append(document)
+        for collection_name, documents in by_collection.items():
+            collection = client[CASE_DATABASE_NAME][collection_name]
+            try:
+                collection.insert_many(documents, ordered=False)
+            except BulkWriteError as e:
+                # duplicate key (11000) = เคยบันทึกแล้ว ถือว่าสำเร็จ
+                bad = {err["index"] for err in e.details.get("writeErrors", []) if err.get("code") != 11000}
+                failed.extend((collection_name, documents[i]) for i in sorted(bad))
+            except Exception:
+                failed.extend((collection_name, d) for d in documents)
+                continue
+            if self.on_saved:
+                self.on_saved(collection_name)
+        return failed
+
+    def _write_with_retry(self, batch):
+        """คืนค่า True ถ้าบันทึกครบ, False ถ้าต้องเก็บลง journal"""
+        for attempt in range(self.max_retries):
+            failed = self._insert(batch)
+            self._mark_saved(batch, failed)
+            if not failed:
+                return True
+            batch = failed
+            if attempt < self.max_retries - 1:
+                delay = min(LOG_WRITER_BACKOFF_BASE * (2 ** attempt), LOG_WRITER_BACKOFF_MAX)
+                time.sleep(delay * random.uniform(0.5, 1.5))
+        self._spill(batch)
+        return False
+
+    def _spill(self, batch):
+        """เขียนเอกสารที่ส่งไม่สำเร็จลงไฟล์ journal คืน True ถ้าเขียนสำเร็จ (เขียนไม่ได้ -> เก็บใน memory, คืน False)"""
+        try:
+            with self._journal_lock:
+                with open(self.journal_path, "a", encoding="utf-8") as f:
+                    for collection_name, document in batch:
+                        f.write(json_util.dumps({"collection": collection_name, "document": document}, ensure_ascii=False) + "\n")
+        except OSError as e:
+            log_writer_logger.warning("cannot write journal %s (%s); keeping %d documents in memory",
+                                      self.journal_path, e, len(batch))
+            self._keep_in_memory(batch)
+            return False
+        self._set_status([str(d["_id"]) for _, d in batch], self.STATUS_JOURNALED)
+        return True
+
+    def _keep_in_memory(self, batch):
+        """เก็บเอกสารไว้ส่งซ้ำรอบหน้า ถ้าเกิน LOG_MEMORY_BACKLOG_MAX จะทิ้งของเก่าสุด (สถานะ failed)"""
+        with self._journal_lock:
+            self._backlog.extend(batch)
+            dropped = self._backlog[:-LOG_MEMORY_BACKLOG_MAX] if len(self._backlog) > LOG_MEMORY_BACKLOG_MAX else []
+            del self._backlog[:len(dropped)]
+        if dropped:
+            log_writer_logger.error("memory backlog full; dropped %d practice documents", len(dropped))
+            self._set_status([str(d["_id"]) for _, d in dropped], self.STATUS_FAILED)
+        kept = {id(d) for _, d in dropped}
+        self._set_status([str(d["_id"]) for _, d in batch if id(d) not in kept], self.STATUS_JOURNALED)
+
+    def _replay_journal(self):
+        """
+        ส่งข้อมูลใน journal (และที่ค้างใน memory) ซ้ำ ถ้ายังไม่สำเร็จจะเก็บกลับไว้ที่เดิม
+        - ไฟล์ .replay ที่ค้างจากรอบก่อน (เช่น process ตายกลางทาง) จะไม่ถูกเขียนทับ แต่ต่อ journal ใหม่เข้าไปท้ายไฟล์
+        - ลบไฟล์ .replay หลังจากทุกรายการบันทึกลง Mongo หรือเขียนกลับลง journal แล้วเท่านั้น
+        """
+        replay_path = self.journal_path + ".replay"
+        with self._journal_lock:
+            batch, self._backlog = self._backlog, []
+            try:
+                self._rotate_journal(replay_path)
+            except OSError as e:
+                log_writer_logger.warning("cannot rotate journal %s: %s", self.journal_path, e)
+        entries = self._read_journal(replay_path) if os.path.exists(replay_path) else []
+        if entries is None:
+            # อ่านไม่ได้: เก็บไฟล์ไว้ลองรอบหน้า ส่งเฉพาะที่ค้างใน memory
+            entries = []
+            replay_path = None
+        batch += entries
+        if not batch:
+            self._remove_replay(replay_path)
+            return
+
+        for i in range(0, len(batch), self.batch_size):
+            chunk = batch[i:i + self.batch_size]
+            failed = self._insert(chunk)
+            self._mark_saved(chunk, failed)
+            if failed:
+                # Mongo ยังไม่กลับมา: เก็บส่วนที่เหลือลง journal แล้วค่อยลองรอบหน้า
+                if self._spill(failed + batch[i + self.batch_size:]):
+                    self._remove_replay(replay_path)
+                # เขียน journal ไม่ได้ (ไปอยู่ใน memory): เก็บ .replay ไว้ด้วย ส่งซ้ำได้เพราะ _id เดิม
+                return
+        self._remove_replay(replay_path)
+
+    def _rotate_journal(self, replay_path):
+        """ย้าย journal ไปเป็นไฟล์ .replay (เรียกขณะถือ _journal_lock)"""
+        if not os.path.exists(self.journal_path):
+            return
+        if not os.path.exists(replay_path):
+            os.replace(self.journal_path, replay_path)
+            return
+        # มี .replay ค้างอยู่: ต่อท้ายแทนการเขียนทับ (ถ้าตายก่อนลบ journal จะได้รายการซ้ำ ซึ่ง insert ซ้ำได้)
+        with open(self.journal_path, encoding="utf-8") as src, open(replay_path, "a", encoding="utf-8") as dst:
+            shutil.copyfileobj(src, dst)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.remove(self.journal_path)
+
+    def _read_journal(self, path):
+        """อ่านรายการจากไฟล์ journal คืน [(collection, document)] หรือ None ถ้าอ่านไฟล์ไม่ได้"""
+        entries = []
+        try:
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        entry = json_util.loads(line)
+                        entries.append((entry["collection"], entry["document"]))
+                    except (ValueError, KeyError, TypeError):
+                        # บรรทัดที่เขียนไม่ครบ (เช่นตายกลางบรรทัด) ข้ามไป
+                        log_writer_logger.warning("skipping malformed journal line in %s", path)
+        except OSError as e:
+            log_writer_logger.warning("cannot read journal %s: %s", path, e)
+            return None
+        return entries
+
+    def _remove_replay(self, replay_path):
+        if not replay_path:
+            return
+        try:
+            os.remove(replay_path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            # ส่งซ้ำรอบหน้าได้ (_id เดิม -> duplicate key ถือว่าสำเร็จ)
+            log_writer_logger.warning("cannot remove journal %s: %s", replay_path, e)
+
+    def _mark_saved(self, batch, failed):
+        failed_docs = {id(d) for _, d in failed}
+        saved = [str(d["_id"]) for _, d in batch if id(d) not in failed_docs]
+        self._set_status(saved, self.STATUS_SAVED)
+
+    def _set_status(self, log_ids, state):
+        with self._status_lock:
+            for log_id in log_ids:
+                self._status[log_id] = state
+                self._status.move_to_end(log_id)
+            while len(self._status) > self.MAX_TRACKED_STATUS:
+                self._status.popitem(last=False)
+
+
+@st.cache_resource(show_spinner=False)
+def get_log_writer():
+    """คิวบันทึกผลตัวเดียวของทั้ง process"""
+    writer = PracticeLogWriter(
+        LOG_JOURNAL_PATH, LOG_WRITER_BATCH_SIZE, LOG_WRITER_FLUSH_INTERVAL, LOG_WRITER_MAX_RETRIES,
+        on_saved=_notify_analytics,
+    )
+    atexit.register(writer.close)
+    return writer
+
+# เก็บ chat_history ทั้งก้อนใน practice_logs ด้วยหรือไม่ (ค่าเริ่มต้น: ไม่ เพราะแต่ละ turn ถูกบันทึกแยกแล้ว)
+PRACTICE_LOG_EMBED_HISTORY = get_secret("PRACTICE_LOG_EMBED_HISTORY") == "1"
+
+def save_practice_log(user_info, case, conversation_history, feedback_text, session_id=None, evaluation=None):
+    """ส่งข้อมูลการฝึกซ้อมเข้าคิวบันทึกลง MongoDB (ไม่รอ) คืนค่า log id หรือ None"""
+    try:
         log_document = {
             "user": user_info,                    
-            "case_id": case_info.get('id'),       
-            "case_name": case_info.get('name'),   
-            "chat_history": conversation_history, 
-            "ai_feedback": feedback_text          
+            "case_id": case.id,       
+            "case_collection": case.collection,
+            "case_name": case.case_name,   
+            "session_id": session_id,
+            "turn_count": len(conversation_history),
+            "ai_feedback": feedback_text,
+            "created_at": datetime.now(timezone.utc),
+            "analytics_pending": True,            # รอ AnalyticsRollup
         }
-
-        collection.insert_one(log_document)
-        return True
+        # คะแนนรายทักษะแบบมีโครงสร้าง (ใช้ทำ rollup / dashboard ไม่ต้อง parse ข้อความซ้ำ)
+        if evaluation:
+            log_document["evaluation"] = evaluation
+            log_document.update(score_fields(evaluation_scores(evaluation)))
+        else:
+            log_document.update(score_fields(extract_skill_scores(feedback_text, get_context_registry().get().skills)))
+        if PRACTICE_LOG_EMBED_HISTORY or not session_id:
+            log_document["chat_history"] = conversation_history
+        return get_log_writer().submit(log_document)
 
     except Exception as e:
         st.error(f"❌ Error saving practice log: {e}")
-        return False
-    finally:
-        if client: client.close()
+        return None
+
+# --- บันทึกบทสนทนาทีละ turn (practice_sessions + practice_turns) ---
+@st.cache_resource(show_spinner=False)
+def ensure_session_indexes():
+    db = get_mongo_client()[CASE_DATABASE_NAME]
+    db[TURN_COLLECTION_NAME].create_index([("session_id", ASCENDING), ("seq", ASCENDING)], unique=True)
+    db[SESSION_COLLECTION_NAME].create_index([("user.name", ASCENDING), ("started_at", DESCENDING)])
+    db[LOG_COLLECTION_NAME].create_index([("session_id", ASCENDING)])
+    return True
+
+def start_practice_session(user_info, case):
+    """สร้าง session ใหม่ของการซักประวัติ คืน session id"""
+    try:
+        ensure_session_indexes()
+    except Exception:
+        pass
+    session_id = str(ObjectId())
+    get_log_writer().submit({
+        "_id": session_id,
+        "user": user_info,
+        "case_ref": list(case.ref),
+        "case_name": case.case_name,
+        "started_at": datetime.now(timezone.utc),
+    }, SESSION_COLLECTION_NAME)
+    return session_id
+
+@st.cache_resource(show_spinner=False)
+def _turn_seq_state():
+    return {"lock": threading.Lock(), "last": 0}
+
+def next_turn_seq():
+    """
+    ลำดับของข้อความ: เวลา (ns) ที่เพิ่มขึ้นเสมอใน process นี้
+    ไม่ใช้ตำแหน่งใน chat_history เพราะหลัง resume อาจมี turn ที่ยังค้างในคิว/journal
+    ซึ่งจะได้เลขซ้ำกับ turn ใหม่ แล้วถูกมองเป็น duplicate key (ข้อความหายเงียบๆ)
+    """
+    state = _turn_seq_state()
+    with state["lock"]:
+        state["last"] = max(time.time_ns(), state["last"] + 1)
+        return state["last"]
+
+def record_turn(session_id, role, content):
+    """
+    ส่งข้อความหนึ่งข้อความเข้าคิว (เขียนเป็นชุดเล็กๆ ด้วย insert_many)
+    _id สร้างตอน submit จึงส่งซ้ำได้โดยไม่เกิดข้อมูลซ้ำ, seq เรียงตามเวลา (ดู next_turn_seq)
+    """
+    if not session_id: return
+    get_log_writer().submit({
+        "session_id": session_id,
+        "seq": next_turn_seq(),
+        "role": role,
+        "content": content,
+        "created_at": datetime.now(timezone.utc),
+    }, TURN_COLLECTION_NAME)
+
+def load_session_turns(session_id):
+    """โหลดบทสนทนาของ session ตามลำดับ คืน [{"role", "content"}]"""
+    cursor = (get_mongo_client()[CASE_DATABASE_NAME][TURN_COLLECTION_NAME]
+              .find({"session_id": session_id}, {"_id": 0, "role": 1, "content": 1})
+              .sort("seq", ASCENDING))
+    return [{"role": t["role"], "content": t["content"]} for t in cursor]
+
+def load_log_transcript(log):
+    """บทสนทนาของ practice_log (log เก่าเก็บ chat_history ไว้ในตัว, log ใหม่อ่านจาก practice_turns)"""
+    if log.get("chat_history"):
+        return log["chat_history"]
+    if log.get("session_id"):
+        return load_session_turns(log["session_id"])
+    return []
+
+def find_resumable_session(session_id):
+    """คืน (session doc, turns) ถ้า session ยังไม่จบ (ยังไม่มี practice_log) ไม่งั้นคืน None"""
+    db = get_mongo_client()[CASE_DATABASE_NAME]
+    meta = db[SESSION_COLLECTION_NAME].find_one({"_id": session_id})
+    if not meta or db[LOG_COLLECTION_NAME].find_one({"session_id": session_id}, {"_id": 1}):
+        return None
+    return meta, load_session_turns(session_id)
 
 
 def create_gvcccm_context(gvcccm_data):
     if not gvcccm_data: return "ไม่พบข้อมูลมาตรฐาน GVCCCM"
-    context_str = "--- หลักการ GVCCCM ---\n"
+    lines = ["--- หลักการ GVCCCM ---"]
     for step in gvcccm_data:
-        context_str += f"- ขั้นตอนที่ {step.get('step_number')}: {step.get('step_name_th')} ({step.get('summary_detail', '')})\n"
-    return context_str
+        lines.append(f"- ขั้นตอนที่ {step.get('step_number')}: {step.get('step_name_th')} ({step.get('summary_detail', '')})")
+    return "\n".join(lines) + "\n"
 
 def create_score_context(assessment_stages):
     if not assessment_stages: return "ไม่พบรายการทักษะ"
-    context_str = "--- เกณฑ์การให้คะแนน Calgary-Cambridge (1-5) ---\n"
+    lines = ["--- เกณฑ์การให้คะแนน Calgary-Cambridge (1-5) ---"]
     for stage in assessment_stages:
-        context_str += f"\n## {stage.get('stage_name_th')}\n"
+        lines.append(f"\n## {stage.get('stage_name_th')}")
         for skill in stage.get('skills', []):
-            context_str += f" - [ ] {skill.get('skill_item')}\n"
-    context_str += "\nคำแนะนำ: ให้คะแนน 1-5 และระบุเหตุผล"
-    return context_str
+            lines.append(f" - [ ] {skill.get('skill_item')}")
+    lines.append("\nคำแนะนำ: ให้คะแนน 1-5 และระบุเหตุผล")
+    return "\n".join(lines)
+
+# --- Prompt context ที่คอมไพล์แล้ว (สร้างครั้งเดียวต่อเวอร์ชันข้อมูล) ---
+# ตรวจว่าข้อมูล Step/Score เปลี่ยนหรือไม่ ไม่บ่อยกว่าทุกกี่วินาที
+# (ปกติ CacheInvalidator จะ invalidate ทันทีที่มีการแก้ไข ค่านี้เป็นแค่ตาข่ายกันพลาด)
+CONTEXT_RECHECK_INTERVAL = get_int_secret("CONTEXT_RECHECK_INTERVAL", 3600)
+
+
+@dataclass(frozen=True)
+class CompiledContexts:
+    """ข้อความ prompt ของ GVCCCM / Calgary-Cambridge ที่สร้างเสร็จแล้ว (immutable แชร์ทุก session)"""
+    version: str
+    gvcccm: str
+    score: str
+    skills: tuple = ()      # ((ชื่อช่วง, ทักษะ), ...) ใช้จับคู่คะแนนรายทักษะ
+
+
+def data_version(*sources):
+    """content hash ของข้อมูลต้นทาง ใช้บอกว่าข้อมูลเปลี่ยนหรือไม่"""
+    payload = json.dumps(sources, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+def compile_contexts(gvcccm_data, score_stages, version=None):
+    return CompiledContexts(
+        version=version or data_version(gvcccm_data, score_stages),
+        gvcccm=create_gvcccm_context(gvcccm_data) if gvcccm_data else "",
+        score=create_score_context(score_stages) if score_stages else "",
+        skills=tuple(
+            (stage.get('stage_name_th'), skill.get('skill_item'))
+            for stage in score_stages or [] for skill in stage.get('skills', [])
+            if skill.get('skill_item')
+        ),
+    )
+
+
+class ContextRegistry:
+    """
+    เก็บ CompiledContexts ปัจจุบันของทั้ง process
+    - rerun ปกติคืน object เดิมทันที (ไม่ดึง Mongo / ไม่ต่อ string ใหม่)
+    - ถึงรอบตรวจหรือถูก invalidate() จะดึงข้อมูลใหม่ แล้วคอมไพล์ใหม่เฉพาะเมื่อ hash เปลี่ยน
+    """
+
+    def __init__(self, recheck_interval):
+        self.recheck_interval = recheck_interval
+        self._current = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self.compiles = 0
+
+    def get(self):
+        if self._current is not None and time.monotonic() - self._checked_at < self.recheck_interval:
+            return self._current
+        # ให้ refresh ทีละคน คนอื่นใช้เวอร์ชันเดิมไปก่อน
+        if not self._lock.acquire(blocking=self._current is None):
+            return self._current
+        try:
+            self._refresh()
+        finally:
+            self._lock.release()
+        return self._current
+
+    def invalidate(self):
+        """บังคับให้ตรวจข้อมูลใหม่ในการเรียก get() ครั้งถัดไป"""
+        self._checked_at = 0.0
+
+    def _refresh(self):
+        gvcccm_data = fetch_gvcccm_data()
+        score_stages = fetch_score_checklist()
+        self._checked_at = time.monotonic()
+        if self._current is not None and not (gvcccm_data and score_stages):
+            # ดึงไม่สำเร็จ -> ใช้เวอร์ชันเดิมต่อ
+            return
+        version = data_version(gvcccm_data, score_stages)
+        if self._current is None or self._current.version != version:
+            self._current = compile_contexts(gvcccm_data, score_stages, version)
+            self.compiles += 1
+
+
+@st.cache_resource(show_spinner=False)
+def get_context_registry():
+    return ContextRegistry(CONTEXT_RECHECK_INTERVAL)
+
+# --- Invalidate cache เฉพาะส่วนที่ข้อมูลเปลี่ยน (change streams / polling) ---
+CACHE_INVALIDATION_ENABLED = get_secret("CACHE_INVALIDATION") != "0"
+CACHE_POLL_INTERVAL = get_int_secret("CACHE_POLL_INTERVAL", 15)   # วินาที (โหมด polling)
+CACHE_RECONNECT_DELAY = 5
+# error code ของ Mongo: ไม่รองรับ change streams (ไม่ใช่ replica set / ไม่รู้จัก $changeStream)
+CHANGE_STREAM_UNSUPPORTED_CODES = {40573, 40324}
+# resume token เก่าเกิน oplog (ChangeStreamHistoryLost) / change stream ใช้ต่อไม่ได้
+CHANGE_STREAM_RESTART_CODES = {286, 280}
+# watch ล้มติดกันเกินจำนวนนี้ (เช่น Unauthorized ไม่มีสิทธิ์ changeStream) -> เปลี่ยนไป poll แทน
+CHANGE_STREAM_MAX_FAILURES = get_int_secret("CHANGE_STREAM_MAX_FAILURES", 5)
+
+cache_invalidator_logger = logging.getLogger("vet_app.cache_invalidator")
+
+
+class CacheVersions:
+    """
+    เลขเวอร์ชันของข้อมูลแต่ละ collection / เอกสาร ใช้เป็นส่วนหนึ่งของ cache key
+    bump() แล้ว entry เดิมจะไม่ถูกใช้อีก (หมดไปเองตาม max_entries/TTL) โดยไม่กระทบ cache อื่น
+    """
+
+    def __init__(self):
+        self._versions = {}
+        self._lock = threading.Lock()
+
+    def get(self, *key):
+        return self._versions.get(key, 0)
+
+    def bump(self, *key):
+        with self._lock:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            return self._versions[key]
+
+
+@st.cache_resource(show_spinner=False)
+def get_cache_versions():
+    return CacheVersions()
+
+
+class CacheInvalidator:
+    """
+    เฝ้าดู collection เคสและ GVCCCM.Step/Score แล้ว refresh เฉพาะ cache ที่เกี่ยวข้องบน thread เบื้องหลัง
+    - ใช้ change streams (ต้องเป็น replica set เช่น Atlas)
+    - ถ้าใช้ไม่ได้ (mongod เดี่ยว / mongomock) จะ poll เทียบ hash ของเอกสารทุก CACHE_POLL_INTERVAL วินาที
+    - watch ล้มติดกัน CHANGE_STREAM_MAX_FAILURES ครั้ง (เช่นไม่มีสิทธิ์) ก็เปลี่ยนไป poll เช่นกัน
+    """
+
+    def __init__(self, targets, poll_interval):
+        self.poll_interval = poll_interval
+        self.modes = {}    # "db.collection" -> change_stream | polling | reconnecting
+        self.errors = {}   # "db.collection" -> error ล่าสุดของ watch
+        self.events = 0
+        for db_name, collection_name in targets:
+            threading.Thread(
+                target=self._watch, args=(db_name, collection_name),
+                name=f"cache-invalidator-{db_name}.{collection_name}", daemon=True,
+            ).start()
+
+    def _watch(self, db_name, collection_name):
+        from pymongo.errors import OperationFailure
+
+        key = f"{db_name}.{collection_name}"
+        resume_token = None
+        failures = 0
+        while True:
+            if failures >= CHANGE_STREAM_MAX_FAILURES:
+                cache_invalidator_logger.warning("change stream on %s failed %d times (%s); falling back to polling",
+                                                 key, failures, self.errors.get(key))
+                self.modes[key] = "polling"
+                self._poll(db_name, collection_name)
+                return
+            try:
+                collection = get_mongo_client()[db_name][collection_name]
+                with collection.watch(resume_after=resume_token) as stream:
+                    self.modes[key] = "change_stream"
+                    failures = 0
+                    for change in stream:
+                        resume_token = stream.resume_token
+                        self._on_change(db_name, collection_name, change.get("documentKey", {}).get("_id"))
+            except NotImplementedError:
+                # mongomock ไม่มี change streams -> poll แทน
+                self.modes[key] = "polling"
+                self._poll(db_name, collection_name)
+                return
+            except OperationFailure as e:
+                if e.code in CHANGE_STREAM_UNSUPPORTED_CODES:
+                    self.modes[key] = "polling"
+                    self._poll(db_name, collection_name)
+                    return
+                if e.code in CHANGE_STREAM_RESTART_CODES:
+                    # ต่อจาก token เดิมไม่ได้: เริ่ม watch ใหม่ และถือว่าทุกอย่างอาจเปลี่ยนระหว่างนั้น
+                    resume_token = None
+                    failures += 1
+                    self._resync(db_name, collection_name)
+                    continue
+                # error อื่น (เช่น สิทธิ์ / เครือข่าย) -> รอแล้ว watch ใหม่
+                failures += 1
+                self._watch_failed(key, f"code {e.code}: {e}", e.code)
+            except Exception as e:
+                failures += 1
+                self._watch_failed(key, repr(e), type(e).__name__)
+
+    def _watch_failed(self, key, error, code):
+        self.modes[key] = "reconnecting"
+        self.errors[key] = error
+        get_metrics().inc("vet_app_cache_watch_errors_total", {"collection": key, "code": str(code)})
+        time.sleep(CACHE_RECONNECT_DELAY)
+
+    def _poll(self, db_name, collection_name):
+        previous = None
+        while True:
+            try:
+                collection = get_mongo_client()[db_name][collection_name]
+                current = {doc["_id"]: data_version(doc) for doc in collection.find()}
+                if previous is not None:
+                    for doc_id in current.keys() | previous.keys():
+                        if current.get(doc_id) != previous.get(doc_id):
+                            self._on_change(db_name, collection_name, doc_id)
+                previous = current
+            except Exception:
+                pass
+            time.sleep(self.poll_interval)
+
+    def _resync(self, db_name, collection_name):
+        """พลาดเหตุการณ์ไปช่วงหนึ่ง: invalidate ทั้ง collection แทนรายเอกสาร"""
+        self._on_change(db_name, collection_name, None)
+        if db_name == CASE_DATABASE_NAME:
+            _query_case.clear()
+
+    def _on_change(self, db_name, collection_name, doc_id):
+        self.events += 1
+        get_metrics().inc("vet_app_cache_invalidations_total", {"collection": f"{db_name}.{collection_name}"})
+        if db_name == GVCCCM_DATABASE_NAME:
+            # เกณฑ์ประเมินเปลี่ยน: คอมไพล์ context ใหม่ทันที (session อื่นใช้ของเดิมจนกว่าจะเสร็จ)
+            registry = get_context_registry()
+            registry.invalidate()
+            registry.get()
+            return
+
+        versions = get_cache_versions()
+        versions.bump(collection_name)                # หน้ารายการของ collection นี้
+        if doc_id is None: return
+        case_id = str(doc_id)
+        version = versions.bump(collection_name, case_id)
+        try:
+            _query_case(collection_name, case_id, version)   # โหลดเคสที่แก้ไว้ล่วงหน้า
+        except Exception:
+            pass  # เอกสารถูกลบ
+
+
+@st.cache_resource(show_spinner=False)
+def start_cache_invalidator():
+    """เริ่ม thread เฝ้าดูการเปลี่ยนแปลง (ครั้งเดียวต่อ process)"""
+    targets = [(CASE_DATABASE_NAME, c) for c in CASE_COLLECTIONS]
+    targets += [(GVCCCM_DATABASE_NAME, GVCCCM_STEP_COLLECTION), (GVCCCM_DATABASE_NAME, GVCCCM_SCORE_COLLECTION)]
+    return CacheInvalidator(targets, CACHE_POLL_INTERVAL)
+
+# --- Warm-up: โหลดสิ่งที่หน้าถัดไปต้องใช้ไว้ล่วงหน้าบน thread เบื้องหลัง ---
+WARMUP_ENABLED = get_secret("WARMUP") != "0"
+
+
+class Warmup:
+    """
+    เตรียมระบบครั้งเดียวต่อ process หลังมีคนเข้าสู่ระบบ: import SDK, เชื่อม Mongo,
+    คอมไพล์เกณฑ์ประเมิน และหน้าแรกของรายการเคส (ผลไปอยู่ใน cache เดียวกับที่หน้าเว็บใช้)
+    ขั้นที่ล้มเหลวไม่เป็นไร หน้าเว็บจะโหลดเองเมื่อใช้จริงตามปกติ
+    """
+
+    def __init__(self):
+        self.status = "idle"    # idle -> running -> done
+        self.steps = {}         # ขั้นตอน -> เวลา (ms)
+        self.errors = {}
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            if self.status != "idle" or not WARMUP_ENABLED:
+                return
+            self.status = "running"
+        threading.Thread(target=self._run, name="warmup", daemon=True).start()
+
+    def _run(self):
+        has_mongo = bool(get_secret("MONGODB_URI", section="mongo"))
+        steps = [("gemini_sdk", gemini)]
+        if has_mongo:
+            steps += [
+                ("mongo", get_mongo_client),
+                ("rubric", lambda: get_context_registry().get()),
+                ("cases", lambda: [fetch_case_page(c, 0, CASE_PAGE_SIZE) for c in CASE_COLLECTIONS]),
+            ]
+        for name, step in steps:
+            started = time.perf_counter()
+            try:
+                step()
+            except Exception as e:
+                self.errors[name] = str(e)
+            self.steps[name] = round((time.perf_counter() - started) * 1000, 1)
+        self.status = "done"
+
+
+@st.cache_resource(show_spinner=False)
+def get_warmup():
+    return Warmup()
 
 # ==============================================================================
 # 3. GEMINI FUNCTIONS
 # ==============================================================================
 
-def final_evaluation(conversation_history, gvcccm_context, score_context):
+# --- Scheduler กลางของทั้ง process: จำกัด rate ตาม quota + คิวตามลำดับความสำคัญ ---
+# quota (requests/minute) ตามโมเดล ปรับได้ด้วย GEMINI_RPM
+GEMINI_RPM_LIMITS = {'gemini-2.5-flash': 1000, 'gemini-2.5-pro': 150, 'gemini-1.5-flash': 1000}
+GEMINI_RPM = get_int_secret("GEMINI_RPM", GEMINI_RPM_LIMITS.get(MODEL_NAME, 60))
+GEMINI_MAX_CONCURRENCY = get_int_secret("GEMINI_MAX_CONCURRENCY", 16)
+GEMINI_MAX_RETRIES = get_int_secret("GEMINI_MAX_RETRIES", 4)
+GEMINI_BACKOFF_BASE = 1.0     # วินาที
+GEMINI_BACKOFF_MAX = 30.0
+LANE_INTERACTIVE = 0          # แชทกับเจ้าของสัตว์ (นักศึกษารออยู่)
+LANE_BATCH = 1                # การประเมินผล / งานเบื้องหลัง
+LANE_NAMES = {LANE_INTERACTIVE: "interactive", LANE_BATCH: "batch"}
+
+def retryable_gemini_errors():
+    """exception ของ Gemini ที่ลองใหม่ได้ (import google.api_core ตอนเกิด error ครั้งแรก)"""
+    from google.api_core import exceptions as google_exceptions
+    return (
+        google_exceptions.ResourceExhausted,     # 429 quota
+        google_exceptions.TooManyRequests,
+        google_exceptions.ServiceUnavailable,    # 503
+        google_exceptions.InternalServerError,   # 500
+        google_exceptions.DeadlineExceeded,
+    )
+
+_queue_feedback = threading.local()
+
+
+class GeminiScheduler:
+    """
+    คุมการเรียก Gemini ของทุก session
+    - token bucket ตาม requests/minute ของโมเดล
+    - จำกัดจำนวน request ที่ทำงานพร้อมกัน
+    - คิวแบบ priority: lane interactive ได้ก่อน lane batch, ใน lane เดียวกันมาก่อนได้ก่อน
+    """
+
+    def __init__(self, rpm, max_concurrency):
+        self.rate = rpm / 60.0
+        self.capacity = max(1.0, rpm / 10.0)   # burst ได้ราว 6 วินาทีของ quota
+        self.max_concurrency = max_concurrency
+        self._tokens = self.capacity
+        self._refilled_at = time.monotonic()
+        self._active = 0
+        self._waiting = []     # heap ของ (lane, ลำดับ)
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self.retries = 0
+        self.throttled = 0
+
+    def acquire(self, lane, report=None):
+        """รอจนได้สิทธิ์เรียก คืนฟังก์ชัน release() (เรียกซ้ำได้)"""
+        entry = (lane, next(self._sequence))
+        started = time.monotonic()
+        last_position = None
+        with self._cond:
+            heapq.heappush(self._waiting, entry)
+        try:
+            while True:
+                with self._cond:
+                    self._refill()
+                    if self._waiting[0] == entry and self._active < self.max_concurrency and self._tokens >= 1:
+                        heapq.heappop(self._waiting)
+                        self._tokens -= 1
+                        self._active += 1
+                        self._cond.notify_all()
+                        break
+                    position = sum(1 for other in self._waiting if other < entry)
+                    wait = (1 - self._tokens) / self.rate if self._tokens < 1 else 0.5
+                    self._cond.wait(min(max(wait, 0.01), 0.5))
+                if report and position != last_position:
+                    report(position, None)
+                    last_position = position
+        except BaseException:
+            # script ถูกหยุด/rerun ระหว่างรอ: เอาตัวเองออกจากคิว ไม่ให้ขวางคนอื่น
+            with self._cond:
+                if entry in self._waiting:
+                    self._waiting.remove(entry)
+                    heapq.heapify(self._waiting)
+                self._cond.notify_all()
+            raise
+
+        get_metrics().observe("vet_app_gemini_queue_wait_seconds", time.monotonic() - started, {"lane": LANE_NAMES[lane]})
+        released = []
+
+        def release():
+            if released: return
+            released.append(True)
+            with self._cond:
+                self._active -= 1
+                self._cond.notify_all()
+        return release
+
+    def backoff(self, attempt):
+        """exponential backoff แบบ full jitter"""
+        return random.uniform(0, min(GEMINI_BACKOFF_BASE * (2 ** attempt), GEMINI_BACKOFF_MAX))
+
+    def record_retry(self, error):
+        from google.api_core import exceptions as google_exceptions
+
+        with self._cond:
+            self.retries += 1
+            if isinstance(error, (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)):
+                self.throttled += 1
+                # โดน 429: ทิ้ง token ที่เหลือ ให้ทุกคนชะลอพร้อมกัน
+                self._tokens = min(self._tokens, 0.0)
+
+    def stats(self):
+        with self._cond:
+            self._refill()
+            return {
+                "active": self._active,
+                "queued": len(self._waiting),
+                "tokens": round(self._tokens, 2),
+                "retries": self.retries,
+                "throttled": self.throttled,
+            }
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+
+
+@st.cache_resource(show_spinner=False)
+def get_gemini_scheduler():
+    """scheduler ตัวเดียวของทั้ง process"""
+    return GeminiScheduler(GEMINI_RPM, GEMINI_MAX_CONCURRENCY)
+
+class _ReleasingStream:
+    """
+    ห่อ stream ของ Gemini ให้คืนสิทธิ์ใน scheduler เมื่ออ่านจบ / error / close()
+    (generator ธรรมดาที่ถูก close ก่อนเริ่มอ่านจะไม่รัน finally จึงใช้ class แทน)
+    """
+
+    def __init__(self, stream, release):
+        self._stream = iter(stream)
+        self._release = release
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            return next(self._stream)
+        except BaseException:
+            self.close()
+            raise
+
+    def close(self):
+        self._release()
+        close = getattr(self._stream, "close", None)
+        if close: close()
+
+    def __del__(self):
+        self._release()
+
+def call_gemini(op, request, stream=False, lane=LANE_INTERACTIVE):
+    """
+    เรียก Gemini ผ่าน scheduler กลาง (รอคิว + rate limit + retry แบบ backoff) และเก็บ metrics
+    request: ฟังก์ชันที่เรียก SDK จริง เช่น lambda: model.generate_content(...)
+    stream=True จะถือสิทธิ์ใน scheduler ไว้จนกว่าจะอ่าน stream จบ
+    """
+    scheduler = get_gemini_scheduler()
+    report = getattr(_queue_feedback, "report", None)
+    for attempt in range(GEMINI_MAX_RETRIES + 1):
+        release = scheduler.acquire(lane, report)
+        try:
+            response = _call_gemini_once(op, request, stream)
+        except retryable_gemini_errors() as e:
+            release()
+            if attempt >= GEMINI_MAX_RETRIES:
+                raise
+            scheduler.record_retry(e)
+            delay = scheduler.backoff(attempt)
+            if report:
+                report(None, delay)
+            time.sleep(delay)
+            continue
+        except Exception:
+            release()
+            raise
+        if stream:
+            return _ReleasingStream(response, release)
+        release()
+        return response
+
+@contextmanager
+def queue_feedback(placeholder):
+    """แสดงลำดับคิว / การลองใหม่ใน placeholder ระหว่างรอ Gemini (เฉพาะ thread ของหน้าเว็บ)"""
+    def report(position, retry_in):
+        if retry_in is not None:
+            placeholder.caption(f"⏳ ระบบมีผู้ใช้งานมาก กำลังลองใหม่ใน {retry_in:.0f} วินาที...")
+        elif position:
+            placeholder.caption(f"⏳ รอคิว AI ลำดับที่ {position}")
+        else:
+            placeholder.empty()
+
+    _queue_feedback.report = report
+    try:
+        yield
+    finally:
+        _queue_feedback.report = None
+        placeholder.empty()
+
+# --- จัดการ context ของแชทให้มีขนาดคงที่ (token budget + rolling summary) ---
+CHAT_CONTEXT_TOKEN_BUDGET = get_int_secret("CHAT_CONTEXT_TOKEN_BUDGET", 2000)
+CHAT_CONTEXT_MIN_MESSAGES = 4        # ข้อความล่าสุดที่เก็บแบบเต็มเสมอ
+EVAL_CHUNK_TOKEN_BUDGET = get_int_secret("EVAL_CHUNK_TOKEN_BUDGET", 6000)
+EVAL_MAP_WORKERS = 4
+
+OWNER_SUMMARY_INSTRUCTION = (
+    "คุณคือผู้ช่วยจดบันทึกการซักประวัติสัตว์ป่วย "
+    "จงสรุปข้อเท็จจริงทางคลินิกที่เจ้าของสัตว์ได้บอกสัตวแพทย์ไปแล้ว "
+    "(อาการ ระยะเวลา ประวัติการรักษา ยา อาหาร วัคซีน สภาพแวดล้อม ฯลฯ) รวมกับสรุปเดิม "
+    "เขียนเป็นข้อสั้นๆ ห้ามเพิ่มข้อมูลที่ไม่ได้พูดถึง"
+)
+EVAL_MAP_INSTRUCTION = (
+    "คุณคืออาจารย์สัตวแพทย์ที่กำลังจดบันทึกการสังเกตนักศึกษา "
+    "อ่านบทสนทนาช่วงนี้แล้วบันทึกพฤติกรรมการสื่อสารของนักศึกษาที่เกี่ยวข้องกับแต่ละทักษะในเกณฑ์ "
+    "พร้อมยกคำพูดสั้นๆ เป็นหลักฐาน ยังไม่ต้องให้คะแนน\n"
+)
+
+
+def estimate_tokens(text):
+    """ประมาณจำนวน token แบบเร็ว (~3 ตัวอักษรต่อ token) ไม่ต้องเรียก API"""
+    return len(text) // 3 + 1
+
+def _message_tokens(message):
+    return estimate_tokens(message["content"]) + 4
+
+
+class BoundedChatSession:
+    """
+    แชทกับเจ้าของสัตว์แบบจำกัดขนาด context (ใช้แทน ChatSession ของ SDK)
+    - ส่งเฉพาะข้อความล่าสุดที่อยู่ใน token budget
+    - ข้อความเก่าถูกย่อเป็น "สรุปสิ่งที่เล่าไปแล้ว" ต่อท้าย system instruction
+    ทำให้ขนาด input ต่อ turn คงที่ไม่ว่าจะคุยยาวแค่ไหน
+    """
+
+    def __init__(self, system_prompt, token_budget, history=None):
+        self.system_prompt = system_prompt
+        self.token_budget = token_budget
+        self.summary = ""
+        self.window = [dict(m) for m in history or []]   # [{"role": "user"|"model", "content": str}]
+        self.compactions = 0
+        self.compaction_failures = 0
+        self._compact_if_needed()
+
+    def send_message(self, prompt, stream=False):
+        """interface เดียวกับ ChatSession.send_message"""
+        model = gemini().GenerativeModel(model_name=MODEL_NAME, system_instruction=self._system_instruction())
+        contents = [{"role": m["role"], "parts": [m["content"]]} for m in self.window]
+        contents.append({"role": "user", "parts": [prompt]})
+        response = call_gemini("owner_chat", lambda: model.generate_content(contents, stream=stream), stream)
+        if stream:
+            return self._record_stream(prompt, response)
+        self._record(prompt, response.text)
+        return response
+
+    def context_tokens(self):
+        return estimate_tokens(self._system_instruction()) + sum(_message_tokens(m) for m in self.window)
+
+    def _system_instruction(self):
+        if not self.summary:
+            return self.system_prompt
+        return (
+            f"{self.system_prompt}"
+            "--------------------------------------------------\n"
+            "สิ่งที่คุณเล่าให้หมอฟังไปแล้วก่อนหน้านี้ (ต้องตอบให้สอดคล้องกัน):\n"
+            f"{self.summary}\n"
+        )
+
+    def _record_stream(self, prompt, response):
+        parts = []
+        for chunk in response:
+            parts.append(chunk.text or "")
+            yield chunk
+        self._record(prompt, "".join(parts))
+
+    def _record(self, prompt, reply):
+        self.window.append({"role": "user", "content": prompt})
+        self.window.append({"role": "model", "content": reply})
+        self._compact_if_needed()
+
+    def _compact_if_needed(self):
+        window_tokens = sum(_message_tokens(m) for m in self.window)
+        if window_tokens <= self.token_budget:
+            return
+        # ย่อจนเหลือครึ่ง budget เพื่อไม่ต้องสรุปใหม่ทุก turn
+        evict_count = 0
+        while len(self.window) - evict_count > CHAT_CONTEXT_MIN_MESSAGES and window_tokens > self.token_budget // 2:
+            window_tokens -= _message_tokens(self.window[evict_count])
+            evict_count += 1
+        if not evict_count:
+            return
+        # สรุปให้สำเร็จก่อนค่อยตัดข้อความออก: ถ้าสรุปไม่ได้ (429 / timeout) เก็บไว้ครบแล้วลองใหม่ turn หน้า
+        try:
+            self.summary = summarize_owner_facts(self.summary, self.window[:evict_count])
+        except Exception as e:
+            self.compaction_failures += 1
+            log_call_event("gemini", "owner_summary_skipped", 0.0, False, error=str(e))
+            return
+        del self.window[:evict_count]
+        self.compactions += 1
+
+
+def summarize_owner_facts(previous_summary, messages):
+    """รวมสรุปเดิมกับข้อความที่ถูกตัดออก ให้เหลือเฉพาะข้อเท็จจริงทางคลินิก"""
+    transcript = "\n".join(
+        f"{'สัตวแพทย์' if m['role'] == 'user' else 'เจ้าของสัตว์'}: {m['content']}" for m in messages
+    )
+    model = gemini().GenerativeModel(model_name=MODEL_NAME, system_instruction=OWNER_SUMMARY_INSTRUCTION)
+    response = call_gemini("owner_summary", lambda: model.generate_content(
+        f"สรุปเดิม:\n{previous_summary or '-'}\n\nบทสนทนาเพิ่มเติม:\n{transcript}"
+    ))
+    return response.text.strip()
+
+def build_owner_prompt(case):
+    """System Prompt ของเจ้าของสัตว์จากข้อมูลเคส"""
+    return (
+        f"คุณคือเจ้าของสัตว์เลี้ยงชื่อ '{case.pet_name}'\n"
+        f"ข้อมูลสัตว์เลี้ยงและอาการ: {case.pet_details}\n"
+        f"บทบาทของคุณคือ: {case.role_th}\n"
+        f"บุคลิกและน้ำเสียงของคุณ (Tone): {case.personality_tone}\n"
+        "--------------------------------------------------\n"
+        "คำสั่ง:\n"
+        "1. จงสวมบทบาทเป็นเจ้าของสัตว์อย่างสมจริง ตามข้อมูลด้านบน\n"
+        "2. ตอบคำถามนักสัตวแพทย์ (User) ตามอาการที่เป็นจริง\n"
+        "3. ห้ามหลุดบท ห้ามบอกว่าเป็น AI\n"
+        "4. ตอบสั้นๆ กระชับ เหมือนบทสนทนาจริง ไม่ต้องทางการมาก\n"
+    )
+
+def chat_history_to_model_history(chat_history):
+    """แปลง chat_history ของหน้าเว็บ (User / AI (Owner)) เป็น role ของ Gemini (user / model)"""
+    return [
+        {"role": "user" if m["role"] == "User" else "model", "content": m["content"]}
+        for m in chat_history
+    ]
+
+def create_owner_chat(system_prompt, history=None):
+    """
+    สร้าง session แชทกับเจ้าของสัตว์ตาม CHAT_CONTEXT_MODE
+    history: [{"role": "user"|"model", "content": str}] สำหรับต่อบทสนทนาเดิม
+    """
+    if CHAT_CONTEXT_MODE == "full":
+        model = gemini().GenerativeModel(model_name=MODEL_NAME, system_instruction=system_prompt)
+        chat = model.start_chat(history=[{"role": m["role"], "parts": [m["content"]]} for m in history or []])
+        return InstrumentedChatSession(chat)
+    return BoundedChatSession(system_prompt, CHAT_CONTEXT_TOKEN_BUDGET, history)
+
+
+class InstrumentedChatSession:
+    """ครอบ ChatSession ของ SDK (โหมด full) ให้เก็บ metrics เหมือน BoundedChatSession"""
+
+    def __init__(self, chat):
+        self.chat = chat
+
+    def send_message(self, prompt, stream=False):
+        return call_gemini("owner_chat", lambda: self.chat.send_message(prompt, stream=stream), stream)
+
+def _iter_stream_text(response, timing):
+    """แปลง stream ของ Gemini เป็นข้อความทีละ chunk พร้อมจับเวลา token แรก"""
+    for chunk in response:
+        text = chunk.text
+        if not text: continue
+        if timing["first_token"] is None:
+            timing["first_token"] = time.perf_counter()
+        yield text
+
+def send_owner_message(chat_session, prompt, streaming):
+    """
+    ส่งคำถามถึงเจ้าของสัตว์ (AI) และแสดงคำตอบในหน้าแชท
+    คืนค่า (ข้อความคำตอบ, metrics ของ turn นี้)
+    """
+    started = time.perf_counter()
+    timing = {"first_token": None}
+    with st.chat_message("AI (Owner)"):
+        with queue_feedback(st.empty()):
+            if streaming:
+                response = chat_session.send_message(prompt, stream=True)
+                ai_msg = st.write_stream(_iter_stream_text(response, timing))
+            else:
+                with st.spinner("..."):
+                    response = chat_session.send_message(prompt)
+                    ai_msg = response.text
+                timing["first_token"] = time.perf_counter()
+                st.write(ai_msg)
+    finished = time.perf_counter()
+
+    first_token = timing["first_token"] or finished
+    metrics = {
+        "mode": "stream" if streaming else "blocking",
+        "ttft_ms": round((first_token - started) * 1000, 1),
+        "total_ms": round((finished - started) * 1000, 1),
+    }
+    if hasattr(chat_session, "context_tokens"):
+        metrics["context_tokens"] = chat_session.context_tokens()
+    return ai_msg, metrics
+
+def turn_metrics_sidebar(turn_metrics):
+    """สรุปเวลา time-to-first-token / เวลารวม ของแต่ละโหมดใน sidebar"""
+    if not turn_metrics: return
+    with st.sidebar.expander("⏱️ เวลาตอบกลับ", expanded=False):
+        last = turn_metrics[-1]
+        st.caption(f"ล่าสุด ({last['mode']}): token แรก {last['ttft_ms']:.0f} ms / รวม {last['total_ms']:.0f} ms")
+        if "context_tokens" in last:
+            st.caption(f"ขนาด context (โดยประมาณ): {last['context_tokens']} tokens")
+        for mode in ("stream", "blocking"):
+            rows = [m for m in turn_metrics if m["mode"] == mode]
+            if not rows: continue
+            avg_ttft = sum(m["ttft_ms"] for m in rows) / len(rows)
+            avg_total = sum(m["total_ms"] for m in rows) / len(rows)
+            st.caption(f"{mode} ({len(rows)} ครั้ง): เฉลี่ย token แรก {avg_ttft:.0f} ms / รวม {avg_total:.0f} ms")
+
+# --- ตั้งค่า cache ผลการประเมิน ---
+EVAL_CACHE_TTL = get_int_secret("EVAL_CACHE_TTL", 7 * 24 * 3600)         # วินาที
+EVAL_CACHE_MAX_ENTRIES = get_int_secret("EVAL_CACHE_MAX_ENTRIES", 512)     # จำนวนใน memory
+EVAL_CACHE_USE_MONGO = get_secret("EVAL_CACHE_MONGO") == "1"               # เปิด tier ที่ 2 ใน Mongo
+
+
+def normalize_transcript(conversation_history):
+    """แปลงบทสนทนาเป็นข้อความมาตรฐาน (ตัดช่องว่างเกิน) เพื่อใช้ทั้งเป็น prompt และ cache key"""
+    return "\n".join(
+        f"{str(item['role']).strip()}: {' '.join(str(item['content']).split())}"
+        for item in conversation_history
+    )
+
+def evaluation_cache_key(model_name, system_instruction, transcript):
+    """hash ของ (โมเดล, system instruction, บทสนทนา) ใช้เป็น key ของผลประเมิน"""
+    payload = json.dumps([model_name, system_instruction, transcript], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class EvaluationCache:
+    """
+    cache ผลการประเมิน 2 ชั้น
+    1. memory (LRU + TTL) ใช้ร่วมกันทุก session ใน process
+    2. MongoDB (เลือกเปิดได้) ใช้ร่วมกันข้าม process/redeploy, หมดอายุด้วย TTL index
+    """
+
+    def __init__(self, ttl, max_entries, use_mongo):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.use_mongo = use_mongo
+        self._entries = OrderedDict()  # key -> (เวลาหมดอายุ, ข้อความ)
+        self._lock = threading.Lock()
+        self._mongo_index_ready = False
+        self.memory_hits = 0
+        self.mongo_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                get_metrics().inc("vet_app_cache_events_total", {"cache": "evaluation", "result": "hit_memory"})
+                return entry[1]
+            if entry:
+                del self._entries[key]
+
+        text = self._mongo_get(key) if self.use_mongo else None
+        with self._lock:
+            if text is None:
+                self.misses += 1
+            else:
+                self.mongo_hits += 1
+        result = "miss" if text is None else "hit_mongo"
+        get_metrics().inc("vet_app_cache_events_total", {"cache": "evaluation", "result": result})
+        if text is None:
+            return None
+        self._remember(key, text)
+        return text
+
+    def put(self, key, text):
+        self._remember(key, text)
+        if self.use_mongo:
+            self._mongo_put(key, text)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.memory_hits + self.mongo_hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "memory_hits": self.memory_hits,
+                "mongo_hits": self.mongo_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": ((self.memory_hits + self.mongo_hits) / lookups) if lookups else 0.0,
+            }
+
+    def _remember(self, key, text):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl, text)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _mongo_collection(self):
+        client = get_mongo_client()
+        if not client: return None
+        collection = client[CASE_DATABASE_NAME][EVAL_CACHE_COLLECTION_NAME]
+        if not self._mongo_index_ready:
+            collection.create_index("expires_at", expireAfterSeconds=0)
+            self._mongo_index_ready = True
+        return collection
+
+    def _mongo_get(self, key):
+        try:
+            collection = self._mongo_collection()
+            if collection is None: return None
+            doc = collection.find_one({"_id": key, "expires_at": {"$gt": datetime.now(timezone.utc)}})
+            return doc["feedback"] if doc else None
+        except Exception:
+            # tier ที่ 2 ล่มไม่ควรทำให้ประเมินผลไม่ได้
+            return None
+
+    def _mongo_put(self, key, text):
+        # ส่งผ่านคิว write-behind (ถ้ามี key ซ้ำจะถูกข้ามเพราะ _id ซ้ำ)
+        get_log_writer().submit({
+            "_id": key,
+            "model": MODEL_NAME,
+            "feedback": text,
+            "expires_at": datetime.now(timezone.utc) + timedelta(seconds=self.ttl),
+        }, EVAL_CACHE_COLLECTION_NAME)
+
+
+@st.cache_resource(show_spinner=False)
+def get_evaluation_cache():
+    """cache ผลการประเมินตัวเดียวของทั้ง process"""
+    return EvaluationCache(EVAL_CACHE_TTL, EVAL_CACHE_MAX_ENTRIES, EVAL_CACHE_USE_MONGO)
+
+def build_evaluation_instruction(gvcccm_context, score_context, structured=False):
+    if structured:
+        output = (
+            "ตอบเป็น JSON ตาม schema เท่านั้น: ให้คะแนน 1-5 ทุกทักษะในรายการ (ใช้ชื่อทักษะตามรายการ) "
+            "พร้อมเหตุผลสั้นๆ ไม่เกิน 1 ประโยค, summary = สรุปภาพรวม, suggestions = ข้อเสนอแนะเป็นข้อๆ"
+        )
+    else:
+        output = "โปรดให้ Feedback 3 ส่วน: 1. คะแนนรายทักษะ 2. สรุปภาพรวม 3. ข้อเสนอแนะ"
+    return (
+        "คุณคืออาจารย์สัตวแพทย์ผู้เชี่ยวชาญ หน้าที่คือประเมินนักศึกษาตามหลัก GVCCCM "
+        "โดยใช้ข้อมูลต่อไปนี้:\n"
+        f"{score_context}\n"
+        f"{gvcccm_context}\n"
+        f"{output}"
+    )
+
+# --- ผลประเมินแบบมีโครงสร้าง (JSON mode + response_schema) ---
+EVAL_STRUCTURED = get_secret("EVAL_STRUCTURED") != "0"
+EVAL_REPAIR_INSTRUCTION = (
+    "คุณแก้ JSON ผลการประเมินให้ถูกต้องตาม schema โดยคงเนื้อหาเดิมไว้ "
+    "ชื่อทักษะต้องตรงกับรายการใน schema และคะแนนเป็นจำนวนเต็ม 1-5"
+)
+
+
+def evaluation_schema(skills):
+    """response_schema ของ Gemini สร้างจากรายการทักษะใน Score checklist"""
+    return {
+        "type": "object",
+        "properties": {
+            "skills": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "skill": {"type": "string", "enum": [skill for _, skill in skills]},
+                        "score": {"type": "integer"},
+                        "reason": {"type": "string"},
+                    },
+                    "required": ["skill", "score", "reason"],
+                },
+            },
+            "summary": {"type": "string"},
+            "suggestions": {"type": "array", "items": {"type": "string"}},
+        },
+        "required": ["skills", "summary", "suggestions"],
+    }
+
+def evaluation_generation_config(skills):
+    return {"response_mime_type": "application/json", "response_schema": evaluation_schema(skills)}
+
+def parse_evaluation(text, skills):
+    """
+    ตรวจ JSON ผลประเมินตาม schema คืน {"skills": [{"stage", "skill", "score", "reason"}], "summary", "suggestions"}
+    ยอมรับ code fence / ข้อความเกินหน้า-หลัง JSON
+    raise ValueError ถ้า: ขาด key ที่ต้องมี, คะแนนไม่ใช่จำนวนเต็ม 1-5, ทักษะไม่อยู่ใน checklist/ซ้ำ, หรือให้คะแนนไม่ครบทุกทักษะ
+    """
+    text = (text or "").strip()
+    start, end = text.find("{"), text.rfind("}")
+    if start < 0 or end < start:
+        raise ValueError("no JSON object in response")
+    try:
+        data = json.loads(text[start:end + 1])
+    except json.JSONDecodeError as e:
+        raise ValueError(f"invalid JSON: {e}") from e
+    if not isinstance(data, dict):
+        raise ValueError("response must be a JSON object")
+    missing = [key for key in ("skills", "summary", "suggestions") if key not in data]
+    if missing:
+        raise ValueError(f"missing required keys: {', '.join(missing)}")
+    if not isinstance(data["skills"], list):
+        raise ValueError("'skills' must be an array")
+    if not isinstance(data["summary"], str) or not data["summary"].strip():
+        raise ValueError("'summary' must be a non-empty string")
+    if not isinstance(data["suggestions"], list) or not all(isinstance(s, str) for s in data["suggestions"]):
+        raise ValueError("'suggestions' must be an array of strings")
+
+    known = [(stage, skill, _normalize_label(skill)) for stage, skill in skills]
+    order = {skill: i for i, (_, skill) in enumerate(skills)}
+    scored = {}
+    for item in data["skills"]:
+        if not isinstance(item, dict):
+            raise ValueError("each skill entry must be an object")
+        name = item.get("skill")
+        found = _match_skill(_normalize_label(str(name or "")), known)
+        if not found:
+            raise ValueError(f"unknown skill: {name!r}")
+        if found[1] in scored:
+            raise ValueError(f"duplicate skill: {found[1]!r}")
+        score = item.get("score")
+        # bool เป็น subclass ของ int และ 4.9 ต้องไม่ถูกปัดเป็น 4
+        if isinstance(score, bool) or not (isinstance(score, int) or (isinstance(score, float) and score.is_integer())):
+            raise ValueError(f"score for {found[1]!r} must be an integer, got {score!r}")
+        if not 1 <= score <= 5:
+            raise ValueError(f"score for {found[1]!r} must be 1-5, got {score}")
+        scored[found[1]] = {"stage": found[0], "skill": found[1], "score": int(score), "reason": str(item.get("reason") or "")}
+
+    not_scored = [skill for _, skill in skills if skill not in scored]
+    if not_scored:
+        raise ValueError(f"missing scores for {len(not_scored)} of {len(skills)} skills: {', '.join(not_scored)}")
+    return {
+        "skills": sorted(scored.values(), key=lambda s: order[s["skill"]]),
+        "summary": data["summary"].strip(),
+        "suggestions": [s.strip() for s in data["suggestions"] if s.strip()],
+    }
+
+def evaluation_scores(evaluation):
+    """คะแนนแบบกระชับที่เก็บใน practice_logs (ตัด reason ออก)"""
+    return [{"stage": s["stage"], "skill": s["skill"], "score": s["score"]} for s in evaluation["skills"]]
+
+def render_evaluation_markdown(evaluation):
+    """สร้าง Feedback 3 ส่วน (markdown) จากผลประเมินแบบมีโครงสร้าง"""
+    lines = ["### 1. คะแนนรายทักษะ"]
+    stage = object()
+    for item in evaluation["skills"]:
+        if item["stage"] != stage:
+            stage = item["stage"]
+            if stage: lines.append(f"\n**{stage}**")
+        reason = f" — {item['reason']}" if item["reason"] else ""
+        lines.append(f"- {item['skill']}: **{item['score']}/5**{reason}")
+    lines += ["", "### 2. สรุปภาพรวม", evaluation["summary"] or "-", "", "### 3. ข้อเสนอแนะ"]
+    lines += [f"- {s}" for s in evaluation["suggestions"]] or ["-"]
+    return "\n".join(lines)
+
+def _repair_evaluation(raw_text, error, skills):
+    """ขอให้ Gemini แก้ JSON ที่ไม่ผ่าน schema (ครั้งเดียว) คืนข้อความ JSON ใหม่"""
+    get_metrics().inc("vet_app_evaluation_schema_failures_total", {"stage": "repair"})
+    model = gemini().GenerativeModel(
+        model_name=MODEL_NAME,
+        system_instruction=EVAL_REPAIR_INSTRUCTION,
+        generation_config=evaluation_generation_config(skills),
+    )
+    response = call_gemini("evaluation_repair", lambda: model.generate_content(
+        f"ข้อผิดพลาด: {error}\n\nJSON เดิม:\n{raw_text}"
+    ), lane=LANE_BATCH)
+    return response.text
+
+def chunk_conversation(conversation_history, token_budget):
+    """แบ่งบทสนทนาเป็นช่วงๆ ตามขอบข้อความ ให้แต่ละช่วงไม่เกิน token_budget (โดยประมาณ)"""
+    chunks, current, current_tokens = [], [], 0
+    for item in conversation_history:
+        tokens = _message_tokens(item)
+        if current and current_tokens + tokens > token_budget:
+            chunks.append(current)
+            current, current_tokens = [], 0
+        current.append(item)
+        current_tokens += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+def _evaluation_notes(chunk_index, chunk_count, chunk, score_context):
+    """(map) จดบันทึกหลักฐานรายทักษะจากบทสนทนาหนึ่งช่วง"""
+    model = gemini().GenerativeModel(model_name=MODEL_NAME, system_instruction=EVAL_MAP_INSTRUCTION + score_context)
+    response = call_gemini("evaluation_map", lambda: model.generate_content(
+        f"บทสนทนาช่วงที่ {chunk_index + 1}/{chunk_count}:\n{normalize_transcript(chunk)}"
+    ), lane=LANE_BATCH)
+    return f"### ช่วงที่ {chunk_index + 1}\n{response.text}"
+
+def _generate_evaluation(conversation_history, history_text, system_instruction, score_context, generation_config=None):
+    model = gemini().GenerativeModel(
+        model_name=MODEL_NAME,
+        system_instruction=system_instruction,
+        generation_config=generation_config,
+    )
+    if estimate_tokens(history_text) <= EVAL_CHUNK_TOKEN_BUDGET:
+        response = call_gemini("evaluation", lambda: model.generate_content(
+            f"ประวัติการสนทนา:\n{history_text}\n\nประเมินผลตามคำสั่ง"
+        ), lane=LANE_BATCH)
+        return response.text
+
+    # บทสนทนายาวมาก: map (จดหลักฐานทีละช่วงพร้อมกัน) -> reduce (ประเมินจากบันทึก)
+    chunks = chunk_conversation(conversation_history, EVAL_CHUNK_TOKEN_BUDGET)
+    with ThreadPoolExecutor(max_workers=EVAL_MAP_WORKERS) as pool:
+        notes = list(pool.map(
+            lambda args: _evaluation_notes(args[0], len(chunks), args[1], score_context),
+            enumerate(chunks),
+        ))
+    response = call_gemini("evaluation_reduce", lambda: model.generate_content(
+        "บันทึกการสังเกตจากบทสนทนาแต่ละช่วง (เรียงตามเวลา):\n\n"
+        + "\n\n".join(notes)
+        + "\n\nประเมินผลตามคำสั่ง โดยพิจารณาบทสนทนาทั้งหมด"
+    ), lane=LANE_BATCH)
+    return response.text
+
+def evaluate_transcript(conversation_history, gvcccm_context, score_context, skills=()):
+    """
+    ประเมินบทสนทนาด้วย Gemini (ไม่มี UI) คืนค่า (feedback markdown, ผลแบบมีโครงสร้างหรือ None, มาจาก cache หรือไม่)
+    ถ้าเคยประเมินบทสนทนา + เกณฑ์ชุดเดียวกันแล้วจะตอบจาก cache ทันที
+    บทสนทนาที่ยาวเกิน EVAL_CHUNK_TOKEN_BUDGET จะประเมินแบบ map-reduce
+    มีรายการทักษะ (skills) และเปิด EVAL_STRUCTURED -> ขอผลเป็น JSON ตาม schema แล้ว render เป็น markdown
+    """
+    structured = EVAL_STRUCTURED and bool(skills)
+    history_text = normalize_transcript(conversation_history)
+    system_instruction = build_evaluation_instruction(gvcccm_context, score_context, structured)
+
+    cache = get_evaluation_cache()
+    cache_key = evaluation_cache_key(MODEL_NAME, system_instruction, history_text)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        if not structured:
+            return cached, None, True
+        try:
+            evaluation = parse_evaluation(cached, skills)
+            return render_evaluation_markdown(evaluation), evaluation, True
+        except ValueError:
+            pass  # entry เสีย -> ประเมินใหม่
+
+    generation_config = evaluation_generation_config(skills) if structured else None
+    raw_text = _generate_evaluation(conversation_history, history_text, system_instruction, score_context, generation_config)
+    if not structured:
+        cache.put(cache_key, raw_text)
+        return raw_text, None, False
+
+    try:
+        evaluation = parse_evaluation(raw_text, skills)
+    except ValueError as e:
+        raw_text = _repair_evaluation(raw_text, e, skills)
+        try:
+            evaluation = parse_evaluation(raw_text, skills)
+        except ValueError:
+            # แก้แล้วยังไม่ผ่าน: ประเมินใหม่ด้วย prompt แบบข้อความ (ไม่ cache)
+            # นักศึกษาเห็น markdown ปกติ และคะแนนถูกดึงจากข้อความด้วย extract_skill_scores ตอน rollup
+            get_metrics().inc("vet_app_evaluation_schema_failures_total", {"stage": "fallback"})
+            text_instruction = build_evaluation_instruction(gvcccm_context, score_context)
+            feedback_text = _generate_evaluation(conversation_history, history_text, text_instruction, score_context)
+            return feedback_text, None, False
+    # cache เฉพาะ JSON ที่ผ่านการตรวจแล้ว (กระชับ)
+    cache.put(cache_key, json.dumps(evaluation, ensure_ascii=False))
+    return render_evaluation_markdown(evaluation), evaluation, False
+
+def final_evaluation(conversation_history, gvcccm_context, score_context, skills=()):
     try:
-        with st.spinner("🧠 AI กำลังวิเคราะห์ผลการซักประวัติ..."):
-            history_text = "\n".join([f"{item['role']}: {item['content']}" for item in conversation_history])
+        with st.spinner("🧠 AI กำลังวิเคราะห์ผลการซักประวัติ..."), queue_feedback(st.empty()):
+            feedback_text, evaluation, _ = evaluate_transcript(conversation_history, gvcccm_context, score_context, skills)
             
-            system_instruction = (
-                "คุณคืออาจารย์สัตวแพทย์ผู้เชี่ยวชาญ หน้าที่คือประเมินนักศึกษาตามหลัก GVCCCM "
-                "โดยใช้ข้อมูลต่อไปนี้:\n"
-                f"{score_context}\n"
-                f"{gvcccm_context}\n"
-                "โปรดให้ Feedback 3 ส่วน: 1. คะแนนรายทักษะ 2. สรุปภาพรวม 3. ข้อเสนอแนะ"
-            )
+            st.session_state.final_feedback = feedback_text
+            st.session_state.final_scores = evaluation_scores(evaluation) if evaluation else None
             
-            model = genai.GenerativeModel(
-                model_name=MODEL_NAME,
-                system_instruction=system_instruction
+            # ส่งเข้าคิวบันทึกเบื้องหลัง ไม่ต้องรอ Mongo ก่อนไปหน้าผลประเมิน
+            st.session_state.practice_log_id = save_practice_log(
+                st.session_state.user,        
+                st.session_state.current_case, 
+                conversation_history,          
+                feedback_text,
+                st.session_state.get('chat_session_id'),
+                evaluation,
             )
-            
-            response = model.generate_content(f"ประวัติการสนทนา:\n{history_text}\n\nประเมินผลตามคำสั่ง")
-            
-            st.session_state.final_feedback = response.text
-            
-            with st.spinner("💾 กำลังบันทึกผลการฝึกซ้อม..."):
-                save_success = save_practice_log(
-                    st.session_state.user,        
-                    st.session_state.current_case, 
-                    conversation_history,          
-                    response.text                  
-                )
-                
-                if save_success:
-                    st.toast("✅ บันทึกข้อมูลลง Database เรียบร้อยแล้ว!", icon="💾")
-                else:
-                    st.toast("⚠️ ไม่สามารถบันทึกข้อมูลได้", icon="❌")
 
+            # จบ session แล้ว: เอา ?session= ออก ไม่ให้ reload หน้าผลประเมินพากลับเข้าแชทเดิม
+            # (find_resumable_session ดูจาก practice_logs ซึ่งอาจยังค้างอยู่ในคิว/journal)
+            st.query_params.pop("session", None)
             st.session_state.page = 'feedback'
             st.rerun()
 
+    except retryable_gemini_errors():
+        st.error("❌ ระบบ AI มีผู้ใช้งานมากเกินไป กรุณากดประเมินผลอีกครั้งในอีกสักครู่ (บทสนทนายังอยู่ครบ)")
     except Exception as e:
         st.error(f"❌ Error during evaluation: {e}")
 
+# --- ประเมินผลย้อนหลังแบบกลุ่ม (อาจารย์) ---
+REGRADE_WORKERS = get_int_secret("REGRADE_WORKERS", 8)
+REGRADE_WRITE_BATCH = 20     # เขียนผลกลับ + checkpoint ทุกกี่รายการ
+
+
+@st.cache_resource(show_spinner=False)
+def ensure_log_indexes():
+    """index ของ practice_logs ที่ใช้กรอง (ครั้งเดียวต่อ process)"""
+    collection = get_mongo_client()[CASE_DATABASE_NAME][LOG_COLLECTION_NAME]
+    collection.create_index([("created_at", DESCENDING)])
+    collection.create_index([("case_name", ASCENDING), ("created_at", DESCENDING)])
+    collection.create_index([("user.name", ASCENDING), ("created_at", DESCENDING)])
+    collection.create_index([("regrade.job_id", ASCENDING)])
+    return True
+
+def build_log_filter(spec):
+    """
+    แปลงเงื่อนไขที่อาจารย์เลือกเป็น Mongo query
+    spec: {"date_from": datetime|None, "date_to": datetime|None (ไม่รวม), "case_name": str|None, "student": str|None}
+    """
+    query = {}
+    if spec.get("date_from") or spec.get("date_to"):
+        query["created_at"] = {}
+        if spec.get("date_from"): query["created_at"]["$gte"] = spec["date_from"]
+        if spec.get("date_to"): query["created_at"]["$lt"] = spec["date_to"]
+    if spec.get("case_name"): query["case_name"] = spec["case_name"]
+    if spec.get("student"): query["user.name"] = spec["student"]
+    return query
+
+
+class RegradeJob:
+    """
+    งานประเมินผลซ้ำของ practice_logs ชุดหนึ่ง ตามเกณฑ์ Score/Step ปัจจุบัน
+    - ทำงานบน thread เบื้องหลัง + worker pool (เรียก Gemini ผ่าน lane batch ของ scheduler)
+    - ผลเขียนกลับเป็นชุดด้วย bulk_write ลง field `regrade` ของแต่ละ log
+    - log ที่มี regrade.job_id ของงานนี้แล้วถือว่าเสร็จ จึง resume ต่อจากจุดเดิมได้เสมอ
+    """
+
+    def __init__(self, job_id, spec, contexts):
+        self.job_id = job_id
+        self.spec = spec
+        self.contexts = contexts
+        self.total = 0
+        self.done = 0
+        self.failed = 0
+        self.status = "queued"
+        self.error = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name=f"regrade-{self.job_id}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def is_alive(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        client = get_mongo_client()
+        logs = client[CASE_DATABASE_NAME][LOG_COLLECTION_NAME]
+        jobs = client[CASE_DATABASE_NAME][REGRADE_JOB_COLLECTION_NAME]
+        try:
+            query = build_log_filter(self.spec)
+            self.total = logs.count_documents(query)
+            self.done = logs.count_documents({**query, "regrade.job_id": self.job_id})
+            pending_ids = [doc["_id"] for doc in logs.find({**query, "regrade.job_id": {"$ne": self.job_id}}, {"_id": 1})]
+            self.status = "running"
+            self._checkpoint(jobs)
+
+            updates = []
+            with ThreadPoolExecutor(max_workers=REGRADE_WORKERS) as pool:
+                futures = [pool.submit(self._grade, logs, log_id) for log_id in pending_ids]
+                for future in as_completed(futures):
+                    update = future.result()
+                    if update is None:
+                        continue
+                    updates.append(update)
+                    if len(updates) >= REGRADE_WRITE_BATCH:
+                        self._flush(logs, jobs, updates)
+                        updates = []
+            self._flush(logs, jobs, updates)
+            self.status = "paused" if self._stop.is_set() else "completed"
+        except Exception as e:
+            self.status = "failed"
+            self.error = str(e)
+        self._checkpoint(jobs)
+
+    def _grade(self, logs, log_id):
+        from pymongo import UpdateOne
+
+        if self._stop.is_set():
+            return None
+        try:
+            log = logs.find_one({"_id": log_id}, {"chat_history": 1, "session_id": 1})
+            feedback_text, evaluation, _ = evaluate_transcript(
+                load_log_transcript(log), self.contexts.gvcccm, self.contexts.score, self.contexts.skills
+            )
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            return None
+        return UpdateOne({"_id": log_id}, {"$set": {"regrade": {
+            "job_id": self.job_id,
+            "rubric_version": self.contexts.version,
+            "model": MODEL_NAME,
+            "ai_feedback": feedback_text,
+            "evaluation": evaluation,
+            **score_fields(evaluation_scores(evaluation) if evaluation else extract_skill_scores(feedback_text, self.contexts.skills)),
+            "graded_at": datetime.now(timezone.utc),
+            "analytics_pending": True,
+        }}})
+
+    def _flush(self, logs, jobs, updates):
+        if updates:
+            logs.bulk_write(updates, ordered=False)
+            self.done += len(updates)
+            get_analytics_rollup().notify()
+        self._checkpoint(jobs)
+
+    def _checkpoint(self, jobs):
+        try:
+            jobs.update_one({"_id": self.job_id}, {"$set": {
+                "spec": self.spec,
+                "rubric_version": self.contexts.version,
+                "status": self.status,
+                "total": self.total,
+                "done": self.done,
+                "failed": self.failed,
+                "error": self.error,
+                "updated_at": datetime.now(timezone.utc),
+            }, "$setOnInsert": {"created_at": datetime.now(timezone.utc)}}, upsert=True)
+        except Exception:
+            pass  # checkpoint พลาดได้ เพราะความคืบหน้าจริงอยู่ที่ field regrade ของแต่ละ log
+
+
+@st.cache_resource(show_spinner=False)
+def get_regrade_jobs():
+    """งาน regrade ที่กำลังทำใน process นี้ (job id -> RegradeJob)"""
+    return {}
+
+def start_regrade_job(spec, contexts, created_by, job_id=None):
+    """เริ่มงานใหม่ หรือ resume งานเดิมเมื่อส่ง job_id มา"""
+    try:
+        ensure_log_indexes()
+    except Exception:
+        pass
+    jobs = get_regrade_jobs()
+    job_id = job_id or str(ObjectId())
+    if job_id in jobs and jobs[job_id].is_alive():
+        return jobs[job_id]
+    job = RegradeJob(job_id, spec, contexts)
+    jobs[job_id] = job
+    get_mongo_client()[CASE_DATABASE_NAME][REGRADE_JOB_COLLECTION_NAME].update_one(
+        {"_id": job_id}, {"$setOnInsert": {"created_by": created_by}}, upsert=True
+    )
+    job.start()
+    return job
+
+# --- Analytics: คะแนนรายทักษะ + rollup สะสมแบบ incremental ---
+ROLLUP_COLLECTION_NAME = 'practice_rollups'
+ANALYTICS_ROLLUP_INTERVAL = get_int_secret("ANALYTICS_ROLLUP_INTERVAL", 60)   # วินาที (รอบตรวจ log ใหม่)
+ANALYTICS_ROLLUP_DEBOUNCE = 2.0      # วินาทีที่รอรวม log ที่เพิ่งบันทึก
+ANALYTICS_ROLLUP_BATCH = 500         # log ต่อรอบ aggregation
+ANALYTICS_CLAIM_TIMEOUT = get_int_secret("ANALYTICS_CLAIM_TIMEOUT", 600)  # วินาที ก่อนถือว่า claim ค้าง (ทำซ้ำด้วย token เดิม)
+ANALYTICS_TOKEN_HISTORY = 200        # token ล่าสุดที่จำไว้ในแต่ละแถว rollup (กันบวกซ้ำเมื่อทำ token เดิมซ้ำ)
+OVERALL_SKILL = "*"                  # แถวคะแนนเฉลี่ยทั้ง session
+# มิติของ rollup: ชื่อ -> expression ของ key ใน practice_logs
+ROLLUP_DIMENSIONS = {
+    "student": "$user.name",
+    "case": "$case_name",
+    "cohort": {"$literal": "all"},
+}
+ORIGINAL_SOURCE = "original"
+# ที่มาของคะแนน: prefix ของ field ใน practice_logs -> ชื่อ source ใน rollup
+# ("" = ผลประเมินตอนฝึก, "regrade." = ผลประเมินซ้ำ แยกตาม job)
+ROLLUP_SOURCES = {"": {"$literal": ORIGINAL_SOURCE}, "regrade.": "$regrade.job_id"}
+
+_SCORE_PATTERN = re.compile(r"(?<!\d)([1-5])(?:\.0)?\s*(?:/\s*5|คะแนน|points?)|(?:คะแนน|score)\s*[:：=]?\s*\**\s*([1-5])(?!\d)", re.IGNORECASE)
+_LABEL_NOISE = re.compile(r"[*_#`>\[\]]|^\s*(?:[-•]|\d+(?:\.\d+)*[.)]?)\s*")
+
+
+def _normalize_label(text):
+    return re.sub(r"\s+", " ", _LABEL_NOISE.sub("", text)).strip(" :：-–").lower()
+
+def _match_skill(label, known):
+    """จับคู่ชื่อทักษะ (normalize แล้ว) กับรายการ [(ช่วง, ทักษะ, ชื่อ normalize)] คืน (ช่วง, ทักษะ) หรือ None"""
+    found = next((k for k in known if k[2] == label), None) or \
+            next((k for k in known if k[2] in label or label in k[2]), None)
+    return (found[0], found[1]) if found else None
+
+def extract_skill_scores(feedback_text, skills=()):
+    """
+    ดึงคะแนน 1-5 รายทักษะจากข้อความ feedback ("- ทักษะ: 4/5", "ทักษะ ... คะแนน 4")
+    จับคู่ชื่อกับรายการทักษะใน Score checklist ถ้ามี คืน [{"stage", "skill", "score"}]
+    """
+    known = [(stage, skill, _normalize_label(skill)) for stage, skill in skills]
+    scores, seen = [], set()
+    for line in (feedback_text or "").splitlines():
+        match = _SCORE_PATTERN.search(line)
+        if not match:
+            continue
+        label = _normalize_label(line[:match.start()])
+        if not label:
+            continue
+        stage, skill = None, re.sub(r"[*_`]", "", line[:match.start()]).strip(" -•:：—–")
+        if known:
+            found = _match_skill(label, known)
+            if not found:
+                continue
+            stage, skill = found
+        if skill in seen:
+            continue
+        seen.add(skill)
+        scores.append({"stage": stage, "skill": skill, "score": int(match.group(1) or match.group(2))})
+    return scores
+
+def score_fields(scores):
+    """field ที่เก็บคู่กับ feedback: scores + คะแนนเฉลี่ย (None ถ้าไม่พบคะแนน)"""
+    average = round(sum(s["score"] for s in scores) / len(scores), 2) if scores else None
+    return {"scores": scores, "score_avg": average}
+
+
+def _rollup_pipeline(token, dimension, key_expr, per_skill, prefix=""):
+    """
+    aggregation: log ที่ถูก claim ด้วย token -> รวมตามมิติ -> $merge บวกเพิ่มเข้า rollup เดิม
+    แต่ละแถวจำ token ที่บวกไปแล้ว (tokens) จึงรัน pipeline ของ token เดิมซ้ำได้โดยไม่นับซ้ำ
+    """
+    scores = f"${prefix}scores"
+    value = f"{scores}.score" if per_skill else f"${prefix}score_avg"
+    pipeline = [{"$match": {f"{prefix}analytics.token": token, f"{prefix}score_avg": {"$ne": None}}}]
+    if per_skill:
+        pipeline.append({"$unwind": scores})
+    pipeline += [
+        {"$group": {
+            "_id": {
+                "source": ROLLUP_SOURCES[prefix], "dim": dimension, "key": key_expr,
+                "skill": f"{scores}.skill" if per_skill else OVERALL_SKILL,
+            },
+            "stage": {"$first": f"{scores}.stage" if per_skill else None},
+            "count": {"$sum": 1},
+            "total": {"$sum": value},
+            "min": {"$min": value},
+            "max": {"$max": value},
+            "last_at": {"$max": "$created_at"},
+        }},
+        {"$set": {
+            "source": "$_id.source", "dim": "$_id.dim", "key": "$_id.key", "skill": "$_id.skill",
+            "avg": {"$round": [{"$divide": ["$total", "$count"]}, 2]},
+            "tokens": [token],
+        }},
+        {"$merge": {
+            "into": ROLLUP_COLLECTION_NAME,
+            "on": "_id",
+            "whenMatched": [{"$replaceWith": {"$cond": [
+                {"$in": [token, {"$ifNull": ["$tokens", []]}]},
+                "$$ROOT",   # token นี้บวกไปแล้ว (รอบก่อนล้มกลางทาง)
+                {"$mergeObjects": ["$$ROOT", {
+                    "count": {"$add": ["$count", "$$new.count"]},
+                    "total": {"$add": ["$total", "$$new.total"]},
+                    "min": {"$min": ["$min", "$$new.min"]},
+                    "max": {"$max": ["$max", "$$new.max"]},
+                    "last_at": {"$max": ["$last_at", "$$new.last_at"]},
+                    "avg": {"$round": [{"$divide": [
+                        {"$add": ["$total", "$$new.total"]}, {"$add": ["$count", "$$new.count"]}
+                    ]}, 2]},
+                    "tokens": {"$slice": [
+                        {"$concatArrays": [{"$ifNull": ["$tokens", []]}, [token]]}, -ANALYTICS_TOKEN_HISTORY
+                    ]},
+                }]},
+            ]}}],
+            "whenNotMatched": "insert",
+        }},
+    ]
+    return pipeline
+
+
+class AnalyticsRollup:
+    """
+    อัปเดต practice_rollups แบบ incremental บน thread เบื้องหลัง
+    - ถูกปลุกเมื่อ PracticeLogWriter บันทึก practice_logs / RegradeJob เขียนผลสำเร็จ (และตรวจเองทุก ANALYTICS_ROLLUP_INTERVAL)
+    - log ที่รอ rollup มี analytics_pending=True (partial index) จึงหาได้โดยไม่สแกนทั้ง collection
+    - claim ด้วย token (analytics.token) ก่อน aggregate จึงไม่นับซ้ำแม้มีหลาย process
+    - claim ที่ aggregate ไม่จบ (analytics.in_flight ค้างเกิน ANALYTICS_CLAIM_TIMEOUT) ถูกทำซ้ำด้วย token เดิม
+      ซึ่งไม่บวกซ้ำเพราะแถว rollup จำ token ที่บวกไปแล้ว
+    - ผล regrade (regrade.*) ถูก rollup แยกเป็น source ของแต่ละ job
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.runs = 0
+        self.rolled_up = 0
+        self.error = None
+        self._wake = threading.Event()
+        self._lock = threading.Lock()
+        threading.Thread(target=self._run, name="analytics-rollup", daemon=True).start()
+
+    def notify(self):
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            if self._wake.wait(self.interval):
+                time.sleep(ANALYTICS_ROLLUP_DEBOUNCE)
+            self._wake.clear()
+            try:
+                self.run_once()
+                self.error = None
+            except Exception as e:
+                self.error = str(e)
+                log_call_event("mongo", "analytics_rollup", 0.0, False, error=str(e))
+
+    def run_once(self):
+        with self._lock:
+            db = get_mongo_client()[CASE_DATABASE_NAME]
+            logs = db[LOG_COLLECTION_NAME]
+            skills = get_context_registry().get().skills
+            for prefix in ROLLUP_SOURCES:
+                for token in self._reclaim_stale(logs, prefix):
+                    self._apply(logs, token, prefix)
+                while True:
+                    token = str(ObjectId())
+                    if not self._claim(logs, token, skills, prefix):
+                        break
+                    self._apply(logs, token, prefix)
+            self.runs += 1
+
+    def _apply(self, logs, token, prefix):
+        """รัน pipeline ทุกมิติของ token แล้วปิด claim (ล้มกลางทาง -> in_flight ค้างไว้ให้ _reclaim_stale)"""
+        for dimension, key_expr in ROLLUP_DIMENSIONS.items():
+            for per_skill in (True, False):
+                logs.aggregate(_rollup_pipeline(token, dimension, key_expr, per_skill, prefix))
+        done = logs.update_many(
+            {f"{prefix}analytics.token": token, f"{prefix}analytics.in_flight": True},
+            {"$set": {f"{prefix}analytics.rolled_up_at": datetime.now(timezone.utc)},
+             "$unset": {f"{prefix}analytics.in_flight": ""}},
+        ).modified_count
+        self.rolled_up += done
+        get_metrics().inc("vet_app_analytics_rolled_up_total", value=done)
+
+    def _reclaim_stale(self, logs, prefix=""):
+        """token ของ claim ที่ค้างเกิน ANALYTICS_CLAIM_TIMEOUT (ต่ออายุ claimed_at ก่อน กันหลาย process ทำพร้อมกัน)"""
+        in_flight = f"{prefix}analytics.in_flight"
+        claimed_at = f"{prefix}analytics.claimed_at"
+        now = datetime.now(timezone.utc)
+        cutoff = now - timedelta(seconds=ANALYTICS_CLAIM_TIMEOUT)
+        tokens = []
+        for token in logs.distinct(f"{prefix}analytics.token", {in_flight: True, claimed_at: {"$lt": cutoff}}):
+            renewed = logs.update_many(
+                {f"{prefix}analytics.token": token, in_flight: True, claimed_at: {"$lt": cutoff}},
+                {"$set": {claimed_at: now}},
+            ).modified_count
+            if renewed:
+                log_call_event("mongo", "analytics_reclaim", 0.0, True, token=token, logs=renewed)
+                tokens.append(token)
+        return tokens
+
+    def _claim(self, logs, token, skills, prefix=""):
+        """จอง log ที่รอ rollup (field {prefix}analytics_pending) ทีละชุด คืนจำนวนที่ได้"""
+        from pymongo import UpdateOne
+
+        pending_field = f"{prefix}analytics_pending"
+        pending = list(logs.find(
+            {pending_field: True}, {"ai_feedback": 1, "scores": 1, "evaluation": 1, "regrade": 1}
+        ).limit(ANALYTICS_ROLLUP_BATCH))
+        if not pending:
+            return 0
+        now = datetime.now(timezone.utc)
+        updates = []
+        for log in pending:
+            graded = (log.get("regrade") or {}) if prefix else log
+            fields = {f"{prefix}analytics": {"token": token, "claimed_at": now, "in_flight": True}}
+            if graded.get("evaluation"):
+                # ผลแบบมีโครงสร้าง: ใช้คะแนนที่ตรวจ schema แล้ว ไม่ต้อง parse ข้อความ
+                backfill = score_fields(evaluation_scores(graded["evaluation"]))
+            elif "scores" not in graded:
+                backfill = score_fields(extract_skill_scores(graded.get("ai_feedback"), skills))
+            else:
+                backfill = {}
+            fields.update({f"{prefix}{k}": v for k, v in backfill.items()})
+            updates.append(UpdateOne(
+                {"_id": log["_id"], pending_field: True},
+                {"$set": fields, "$unset": {pending_field: ""}},
+            ))
+        return logs.bulk_write(updates, ordered=False).modified_count
+
+    def rebuild(self):
+        """ล้าง rollup แล้วคำนวณใหม่จาก practice_logs ทั้งหมด (หลังแก้เกณฑ์/แก้ข้อมูลย้อนหลัง/log เก่าก่อนมี analytics)"""
+        with self._lock:
+            db = get_mongo_client()[CASE_DATABASE_NAME]
+            logs = db[LOG_COLLECTION_NAME]
+            db[ROLLUP_COLLECTION_NAME].delete_many({})
+            logs.update_many({}, {
+                "$set": {"analytics_pending": True},
+                "$unset": {"analytics": "", "scores": "", "score_avg": ""},
+            })
+            logs.update_many({"regrade": {"$type": "object"}}, {
+                "$set": {"regrade.analytics_pending": True},
+                "$unset": {"regrade.analytics": ""},
+            })
+        self.run_once()
+
+
+@st.cache_resource(show_spinner=False)
+def ensure_analytics_indexes():
+    db = get_mongo_client()[CASE_DATABASE_NAME]
+    logs = db[LOG_COLLECTION_NAME]
+    for prefix in ROLLUP_SOURCES:
+        # partial index: มีเฉพาะ log ที่รอ rollup จึงเล็กและหาได้ทันที
+        logs.create_index([(f"{prefix}analytics_pending", ASCENDING)],
+                          partialFilterExpression={f"{prefix}analytics_pending": True})
+        logs.create_index([(f"{prefix}analytics.token", ASCENDING)], sparse=True)
+        logs.create_index([(f"{prefix}analytics.claimed_at", ASCENDING)],
+                          partialFilterExpression={f"{prefix}analytics.in_flight": True})
+    logs.create_index([("user.name", ASCENDING), ("score_avg", DESCENDING)])
+    rollups = db[ROLLUP_COLLECTION_NAME]
+    rollups.create_index([("source", ASCENDING), ("dim", ASCENDING), ("key", ASCENDING), ("skill", ASCENDING)])
+    rollups.create_index([("source", ASCENDING), ("dim", ASCENDING), ("skill", ASCENDING), ("avg", ASCENDING)])
+    return True
+
+@st.cache_resource(show_spinner=False)
+def get_analytics_rollup():
+    """ตัวอัปเดต rollup ตัวเดียวของทั้ง process"""
+    try:
+        ensure_analytics_indexes()
+    except Exception:
+        pass
+    return AnalyticsRollup(ANALYTICS_ROLLUP_INTERVAL)
+
+def _notify_analytics(collection_name):
+    if collection_name == LOG_COLLECTION_NAME:
+        get_analytics_rollup().notify()
+
+@st.cache_data(ttl=30, show_spinner=False)
+def fetch_rollups(dimension, key=None, source=ORIGINAL_SOURCE):
+    """อ่าน rollup ที่คำนวณไว้แล้ว (อ่านผ่าน index ไม่สแกน practice_logs)"""
+    query = {"source": source, "dim": dimension}
+    if key is not None:
+        query["key"] = key
+    projection = {"_id": 0, "key": 1, "skill": 1, "stage": 1, "count": 1, "avg": 1, "min": 1, "max": 1, "last_at": 1}
+    return list(get_mongo_client()[CASE_DATABASE_NAME][ROLLUP_COLLECTION_NAME].find(query, projection))
+
+@st.cache_data(ttl=30, show_spinner=False)
+def fetch_rollup_sources():
+    """ชุดผลประเมินที่มี rollup: ต้นฉบับ + regrade job ต่างๆ"""
+    sources = get_mongo_client()[CASE_DATABASE_NAME][ROLLUP_COLLECTION_NAME].distinct(
+        "source", {"dim": "cohort", "skill": OVERALL_SKILL}
+    )
+    return [ORIGINAL_SOURCE] + sorted(s for s in sources if s and s != ORIGINAL_SOURCE)
+
 # ==============================================================================
 # 4. PAGE FUNCTIONS (UPDATED FOR YOUR DATABASE STRUCTURE)
 # ==============================================================================
@@ -223,69 +2568,96 @@ def login_page():
     st.title("🔐 Veterinary Learning Companion")
     with st.form("login_form"):
         username = st.text_input("ชื่อผู้ใช้งาน")
-        role = st.selectbox("สถานะ", ["นักศึกษา", "อาจารย์"])
+        role = st.selectbox("สถานะ", ["นักศึกษา", INSTRUCTOR_ROLE])
         if st.form_submit_button("เข้าสู่ระบบ"):
             if username:
                 st.session_state.user = {'name': username, 'role': role}
                 st.session_state.page = 'case_selection'
+                get_warmup().start()   # เริ่มโหลดเคส/เกณฑ์ระหว่างเปลี่ยนหน้า
                 st.rerun()
             else:
                 st.warning("กรุณากรอกชื่อผู้ใช้งาน")
 
-# --- ฟังก์ชันตัวช่วยดึงข้อมูล (แก้ปัญหา Data ซ่อนใน owner_role) ---
-def get_case_field(case, field_name, default_value="-"):
-    # 1. ลองหาที่ชั้นนอกสุดก่อน (Root Level)
-    if field_name in case:
-        return case[field_name]
-    
-    # 2. ถ้าไม่เจอ ลองมุดเข้าไปหาใน 'owner_role' (ตามรูป Database ของคุณ)
-    owner_role_obj = case.get('owner_role', {})
-    if isinstance(owner_role_obj, dict) and field_name in owner_role_obj:
-        return owner_role_obj[field_name]
-        
-    return default_value
+def _reset_case_page():
+    st.session_state.case_page = 0
 
 def case_selection_page():
     st.title("📋 เลือกเคสฝึกซ้อม")
     st.write(f"ผู้ใช้งาน: **{st.session_state.user['name']}** ({st.session_state.user['role']})")
-    
-    global items
-    if not items:
-        items = fetch_case_scenario()
+    if st.session_state.user['role'] == INSTRUCTOR_ROLE:
+        if st.sidebar.button("🧑‍🏫 ประเมินผลย้อนหลังแบบกลุ่ม"):
+            st.session_state.page = 'batch_grading'
+            st.rerun()
+        if st.sidebar.button("📊 Dashboard ผลการฝึกซ้อม"):
+            st.session_state.page = 'analytics'
+            st.rerun()
+
+    # --- ตัวกรอง: ชนิดสัตว์ (collection) + ค้นหา ---
+    f1, f2 = st.columns([1, 3])
+    with f1:
+        collection_name = st.selectbox(
+            "ชนิดสัตว์", CASE_COLLECTIONS,
+            format_func=lambda c: SPECIES_LABELS.get(c, c),
+            key="case_collection", on_change=_reset_case_page,
+        )
+    with f2:
+        search = st.text_input("ค้นหาเคส", key="case_search", on_change=_reset_case_page).strip()
+
+    page = st.session_state.get('case_page', 0)
+    items, total = fetch_case_page(collection_name, page, CASE_PAGE_SIZE, search)
 
     if not items:
+        if search:
+            st.info("ไม่พบเคสที่ตรงกับคำค้นหา")
+            return
         st.info("⏳ กำลังโหลดข้อมูล หรือ ไม่พบข้อมูลใน Database...")
         # ปุ่ม Reload เผื่อเน็ตหลุด
         if st.button("🔄 โหลดข้อมูลใหม่"):
-            st.cache_data.clear()
+            # refresh เฉพาะรายการเคสของ collection นี้ ไม่ล้าง cache ของทุกคน
+            get_cache_versions().bump(collection_name)
+            get_context_registry().invalidate()
+            st.session_state.case_page = 0
             st.rerun()
         return
 
-    # Loop แสดงรายการเคส
+    # Loop แสดงรายการเคส (เฉพาะหน้าปัจจุบัน)
+    icon = SPECIES_LABELS.get(collection_name, "🐾").split()[0]
     for case in items:
         with st.container(border=True):
             c1, c2 = st.columns([4, 1])
             
-            # --- แก้การดึงข้อมูลให้ตรงกับ DB จริง ---
-            # ดึงชื่อสัตว์ (อยู่ใน owner_role)
-            pet_name = get_case_field(case, 'pet_name', 'ไม่ระบุชื่อ')
-            # ดึงชื่อเคส (อยู่ที่ Root)
-            case_name = get_case_field(case, 'case_name', 'Case Scenario')
-            # ดึงรายละเอียด (อยู่ใน owner_role)
-            pet_details = get_case_field(case, 'pet_details', '')
-
             with c1:
-                # แสดงหัวข้อ: ชื่อสัตว์ + ชื่อเคส
-                st.subheader(f"🐶 {pet_name}")
+                # แสดงหัวข้อ: ชื่อสัตว์
+                st.subheader(f"{icon} {case.pet_name}")
                
 
             with c2:
-                if st.button("ดูข้อมูล", key=f"btn_{case.get('_id', 'unknown')}"):
-                    st.session_state.current_case = case
+                if st.button("ดูข้อมูล", key=f"btn_{case.id}"):
+                    # เก็บแค่ตัวอ้างอิง เอกสารเต็มจะโหลดตอนเปิดหน้า case_detail
+                    st.session_state.current_case_ref = (case.collection, case.id)
+                    st.session_state.current_case = None
                     st.session_state.page = 'case_detail'
                     st.rerun()
 
+    # --- เปลี่ยนหน้า ---
+    page_count = max((total + CASE_PAGE_SIZE - 1) // CASE_PAGE_SIZE, 1)
+    p1, p2, p3 = st.columns([1, 2, 1])
+    with p1:
+        if st.button("⬅️ ก่อนหน้า", disabled=page <= 0):
+            st.session_state.case_page = page - 1
+            st.rerun()
+    with p2:
+        st.caption(f"หน้า {page + 1} / {page_count} (ทั้งหมด {total} เคส)")
+    with p3:
+        if st.button("ถัดไป ➡️", disabled=page + 1 >= page_count):
+            st.session_state.case_page = page + 1
+            st.rerun()
+
 def case_detail_page():
+    # โหลดเอกสารเคสฉบับเต็มตอนเปิดหน้านี้ครั้งแรก
+    if not st.session_state.get('current_case') and st.session_state.get('current_case_ref'):
+        st.session_state.current_case = load_case(*st.session_state.current_case_ref)
+
     if 'current_case' not in st.session_state or not st.session_state.current_case:
         st.error("เกิดข้อผิดพลาด: ไม่พบข้อมูลเคส")
         if st.button("กลับหน้าเลือกเคส"):
@@ -295,11 +2667,9 @@ def case_detail_page():
 
     case = st.session_state.current_case
     
-    # ดึงข้อมูลมาเตรียมไว้ (ใช้ฟังก์ชันตัวช่วยเดิม)
-    pet_name = get_case_field(case, 'pet_name')
-    pet_details = get_case_field(case, 'pet_details')
-    role_th = get_case_field(case, 'role_th')
-    personality_tone = get_case_field(case, 'personality_tone') 
+    # field ถูก resolve ไว้แล้วใน Case (รวมที่ซ่อนใน owner_role)
+    pet_name = case.pet_name
+    pet_details = case.pet_details
     
     st.title(f"📄 ข้อมูล: {pet_name}")
     
@@ -316,110 +2686,398 @@ def case_detail_page():
         if st.button("⬅️ ย้อนกลับ"):
             st.session_state.page = 'case_selection'
             st.session_state.current_case = None
+            st.session_state.current_case_ref = None
             st.rerun()
             
     with col_start:
         if st.button("🚀 เริ่มซักประวัติ (Start Chat)", type="primary"):
             # --- สร้าง System Prompt (แก้ให้ตรง field DB) ---
-            sys_instruct = (
-                f"คุณคือเจ้าของสัตว์เลี้ยงชื่อ '{pet_name}'\n"
-                f"ข้อมูลสัตว์เลี้ยงและอาการ: {pet_details}\n"
-                f"บทบาทของคุณคือ: {role_th}\n"
-                f"บุคลิกและน้ำเสียงของคุณ (Tone): {personality_tone}\n"
-                "--------------------------------------------------\n"
-                "คำสั่ง:\n"
-                "1. จงสวมบทบาทเป็นเจ้าของสัตว์อย่างสมจริง ตามข้อมูลด้านบน\n"
-                "2. ตอบคำถามนักสัตวแพทย์ (User) ตามอาการที่เป็นจริง\n"
-                "3. ห้ามหลุดบท ห้ามบอกว่าเป็น AI\n"
-                "4. ตอบสั้นๆ กระชับ เหมือนบทสนทนาจริง ไม่ต้องทางการมาก\n"
-            )
-            
-            st.session_state.owner_system_prompt = sys_instruct
+            st.session_state.owner_system_prompt = build_owner_prompt(case)
             st.session_state.chat_history = []
+            st.session_state.turn_metrics = []
             st.session_state.chat_session = None
+            # เปิด session ใน Mongo แล้วใส่ id ใน URL เพื่อกลับมาทำต่อได้ถ้าหลุด
+            st.session_state.chat_session_id = start_practice_session(st.session_state.user, case)
+            st.query_params["session"] = st.session_state.chat_session_id
             st.session_state.page = 'chat'
             st.rerun()
 
-def chat_page(gvcccm_context, score_context):
+def chat_page(gvcccm_context, score_context, skills=()):
     # ดึงข้อมูลเคสที่ถูกเลือกไว้จาก Session State
-    current_case = st.session_state.get('current_case', {})
+    current_case = st.session_state.get('current_case')
     
-    # ดึงชื่อสัตว์โดยใช้ฟังก์ชันตัวช่วย
-    pet_name = get_case_field(current_case, 'pet_name', 'Case')
+    # ดึงชื่อสัตว์จาก Case
+    pet_name = current_case.pet_name if current_case else 'Case'
     
     # เปลี่ยนการแสดงผล title ให้ใช้ pet_name ที่เราดึงมา
     st.title(f"💬 ห้องตรวจ: {pet_name}")
     
     if 'chat_session' not in st.session_state or st.session_state.chat_session is None:
-        model = genai.GenerativeModel(
-            model_name=MODEL_NAME,
-            system_instruction=st.session_state.owner_system_prompt
-        )
-        st.session_state.chat_session = model.start_chat(history=[])
+        st.session_state.chat_session = create_owner_chat(st.session_state.owner_system_prompt)
 
     with st.sidebar:
         # แสดงข้อมูลย่อๆ เผื่อลืม
         st.caption(f"กำลังซักประวัติเคส: **{pet_name}**") # ใช้ pet_name ที่ดึงมาแสดงใน sidebar
         st.divider()
 
+        st.toggle("แสดงคำตอบแบบ Streaming", value=CHAT_STREAMING_DEFAULT, key="chat_streaming")
+
         st.info("เมื่อกดจบการซักประวัติ ระบบจะประเมินผลและ **บันทึกข้อมูลอัตโนมัติ**")
         if st.button("🛑 จบการซักประวัติและประเมินผล", type="primary"):
-            final_evaluation(st.session_state.chat_history, gvcccm_context, score_context)
+            final_evaluation(st.session_state.chat_history, gvcccm_context, score_context, skills)
     
     for msg in st.session_state.chat_history:
         with st.chat_message(msg["role"]):
             st.write(msg["content"])
             
     if prompt := st.chat_input("พิมพ์คำถามของคุณ..."):
+        session_id = st.session_state.get('chat_session_id')
         st.session_state.chat_history.append({"role": "User", "content": prompt})
+        record_turn(session_id, "User", prompt)
         with st.chat_message("User"):
             st.write(prompt)
             
         try:
-            with st.spinner("..."):
-                response = st.session_state.chat_session.send_message(prompt)
-                ai_msg = response.text
-                
+            ai_msg, metrics = send_owner_message(
+                st.session_state.chat_session, prompt, st.session_state.chat_streaming
+            )
+            # เก็บข้อความเต็มไว้ใช้ตอน final_evaluation เหมือนเดิม
             st.session_state.chat_history.append({"role": "AI (Owner)", "content": ai_msg})
-            with st.chat_message("AI (Owner)"):
-                st.write(ai_msg)
+            record_turn(session_id, "AI (Owner)", ai_msg)
+            st.session_state.turn_metrics.append(metrics)
         except Exception as e:
             st.error(f"Error: {e}")
 
+    turn_metrics_sidebar(st.session_state.turn_metrics)
+
+@st.cache_data(ttl=300, show_spinner=False)
+def fetch_logged_case_names():
+    """ชื่อเคสที่มีใน practice_logs (ใช้เป็นตัวเลือกกรอง)"""
+    try:
+        return sorted(n for n in get_mongo_client()[CASE_DATABASE_NAME][LOG_COLLECTION_NAME].distinct("case_name") if n)
+    except Exception:
+        return []
+
+def _date_range_to_spec(date_range):
+    """แปลงช่วงวันที่จาก st.date_input เป็น datetime (UTC) [เริ่ม, สิ้นสุด)"""
+    dates = list(date_range) if isinstance(date_range, (list, tuple)) else [date_range]
+    to_dt = lambda d: datetime(d.year, d.month, d.day, tzinfo=timezone.utc)
+    date_from = to_dt(dates[0]) if dates else None
+    date_to = to_dt(dates[-1]) + timedelta(days=1) if dates else None
+    return date_from, date_to
+
+def batch_grading_page(contexts):
+    st.title("🧑‍🏫 ประเมินผลย้อนหลังแบบกลุ่ม")
+    if st.session_state.user.get('role') != INSTRUCTOR_ROLE:
+        st.error("หน้านี้สำหรับอาจารย์เท่านั้น")
+        return
+    if st.button("⬅️ กลับหน้าเลือกเคส"):
+        st.session_state.page = 'case_selection'
+        st.rerun()
+
+    st.caption(f"เกณฑ์ที่ใช้ประเมิน: Score/Step เวอร์ชัน `{contexts.version}`")
+    with st.form("regrade_filter"):
+        c1, c2, c3 = st.columns(3)
+        date_range = c1.date_input("ช่วงวันที่", value=())
+        case_name = c2.selectbox("เคส", ["ทั้งหมด"] + fetch_logged_case_names())
+        student = c3.text_input("ชื่อนักศึกษา")
+        if st.form_submit_button("🔍 ค้นหา"):
+            date_from, date_to = _date_range_to_spec(date_range)
+            st.session_state.regrade_spec = {
+                "date_from": date_from,
+                "date_to": date_to,
+                "case_name": None if case_name == "ทั้งหมด" else case_name,
+                "student": student.strip() or None,
+            }
+
+    spec = st.session_state.get('regrade_spec')
+    if spec:
+        try:
+            count = get_mongo_client()[CASE_DATABASE_NAME][LOG_COLLECTION_NAME].count_documents(build_log_filter(spec))
+        except Exception as e:
+            st.error(f"❌ Error counting practice logs: {e}")
+            count = 0
+        st.write(f"พบ **{count}** รายการที่ตรงเงื่อนไข")
+        if count and st.button("▶️ เริ่มประเมินใหม่ทั้งหมด", type="primary"):
+            start_regrade_job(spec, contexts, st.session_state.user['name'])
+            st.rerun()
+
+    st.divider()
+    st.subheader("งานล่าสุด")
+    if st.button("🔄 รีเฟรชความคืบหน้า"):
+        st.rerun()
+    try:
+        saved_jobs = list(get_mongo_client()[CASE_DATABASE_NAME][REGRADE_JOB_COLLECTION_NAME]
+                          .find().sort("created_at", DESCENDING).limit(20))
+    except Exception as e:
+        st.error(f"❌ Error loading jobs: {e}")
+        return
+
+    running = get_regrade_jobs()
+    for saved in saved_jobs:
+        job = running.get(saved["_id"])
+        # ข้อมูลสดจาก thread ถ้ายังทำงานใน process นี้ ไม่งั้นใช้ checkpoint ใน Mongo
+        status = job.status if job else saved.get("status", "-")
+        done = job.done if job else saved.get("done", 0)
+        total = job.total if job else saved.get("total", 0)
+        failed = job.failed if job else saved.get("failed", 0)
+        with st.container(border=True):
+            st.write(f"**{saved['_id']}** · {status} · โดย {saved.get('created_by', '-')}")
+            st.progress(min(done / total, 1.0) if total else 0.0, text=f"{done}/{total} รายการ (ผิดพลาด {failed})")
+            error = job.error if job else saved.get("error")
+            if error:
+                st.caption(f"error: {error}")
+            alive = job is not None and job.is_alive()
+            if alive and st.button("⏸️ หยุดชั่วคราว", key=f"stop_{saved['_id']}"):
+                job.stop()
+                st.rerun()
+            if not alive and status != "completed" and saved.get("spec"):
+                if st.button("▶️ ทำต่อ", key=f"resume_{saved['_id']}"):
+                    start_regrade_job(saved["spec"], contexts, st.session_state.user['name'], job_id=saved["_id"])
+                    st.rerun()
+
+def _skill_table(rows, cohort=None):
+    """แถว rollup รายทักษะ -> ตาราง (เรียงจากทักษะที่อ่อนที่สุด) พร้อมค่าเฉลี่ยทั้งรุ่นถ้ามี"""
+    cohort_avg = {r["skill"]: r.get("avg") for r in cohort or []}
+    table = [
+        {
+            "ช่วง": r.get("stage") or "-",
+            "ทักษะ": r["skill"],
+            "คะแนนเฉลี่ย": r.get("avg"),
+            **({"เฉลี่ยทั้งรุ่น": cohort_avg.get(r["skill"])} if cohort is not None else {}),
+            "ต่ำสุด": r.get("min"),
+            "สูงสุด": r.get("max"),
+            "จำนวนครั้ง": r.get("count"),
+        }
+        for r in rows if r["skill"] != OVERALL_SKILL
+    ]
+    table.sort(key=lambda row: row["คะแนนเฉลี่ย"] or 0)
+    st.dataframe(table, use_container_width=True, hide_index=True, column_config={
+        "คะแนนเฉลี่ย": st.column_config.ProgressColumn(min_value=1, max_value=5, format="%.2f"),
+    })
+
+def _overview_table(rows, key_label):
+    """แถว rollup ภาพรวม (skill '*') ของแต่ละนักศึกษา/เคส"""
+    table = [
+        {key_label: r["key"], "จำนวนครั้ง": r.get("count"), "คะแนนเฉลี่ย": r.get("avg"), "ล่าสุด": r.get("last_at")}
+        for r in rows if r["skill"] == OVERALL_SKILL
+    ]
+    table.sort(key=lambda row: row["คะแนนเฉลี่ย"] or 0)
+    st.dataframe(table, use_container_width=True, hide_index=True, column_config={
+        "คะแนนเฉลี่ย": st.column_config.ProgressColumn(min_value=1, max_value=5, format="%.2f"),
+    })
+    return [row[key_label] for row in table]
+
+def analytics_page():
+    st.title("📊 Dashboard ผลการฝึกซ้อม")
+    if st.session_state.user.get('role') != INSTRUCTOR_ROLE:
+        st.error("หน้านี้สำหรับอาจารย์เท่านั้น")
+        return
+    c1, c2 = st.columns([1, 1])
+    if c1.button("⬅️ กลับหน้าเลือกเคส"):
+        st.session_state.page = 'case_selection'
+        st.rerun()
+    rollup = get_analytics_rollup()
+    if c2.button("🔄 อัปเดตข้อมูล"):
+        rollup.notify()
+        fetch_rollups.clear()
+        fetch_rollup_sources.clear()
+        st.rerun()
+    st.caption("ข้อมูลสรุปจาก practice_rollups (อัปเดตอัตโนมัติหลังบันทึกผลการฝึกซ้อม)")
+    if rollup.error:
+        st.caption(f"rollup error: {rollup.error}")
+
+    try:
+        source = st.selectbox(
+            "ผลประเมิน", fetch_rollup_sources(),
+            format_func=lambda s: "ผลประเมินตอนฝึก" if s == ORIGINAL_SOURCE else f"ประเมินซ้ำ (job {s})",
+        )
+        cohort = fetch_rollups("cohort", "all", source)
+        students = fetch_rollups("student", source=source)
+        cases = fetch_rollups("case", source=source)
+    except Exception as e:
+        st.error(f"❌ Error loading analytics: {e}")
+        return
+
+    overall = next((r for r in cohort if r["skill"] == OVERALL_SKILL), None)
+    if not overall:
+        st.info("ยังไม่มีผลการฝึกซ้อมที่มีคะแนนรายทักษะ")
+        return
+    m1, m2, m3 = st.columns(3)
+    m1.metric("จำนวนครั้งที่ฝึก", overall["count"])
+    m2.metric("คะแนนเฉลี่ย", overall["avg"])
+    m3.metric("นักศึกษา", sum(1 for r in students if r["skill"] == OVERALL_SKILL))
+
+    tab_cohort, tab_student, tab_case = st.tabs(["ทั้งรุ่น", "รายนักศึกษา", "รายเคส"])
+    with tab_cohort:
+        _skill_table(cohort)
+    with tab_student:
+        names = _overview_table(students, "นักศึกษา")
+        name = st.selectbox("ดูรายทักษะของ", names, key="analytics_student") if names else None
+        if name:
+            _skill_table([r for r in students if r["key"] == name], cohort)
+    with tab_case:
+        case_names = _overview_table(cases, "เคส")
+        case_name = st.selectbox("ดูรายทักษะของเคส", case_names, key="analytics_case") if case_names else None
+        if case_name:
+            _skill_table([r for r in cases if r["key"] == case_name], cohort)
+
+    with st.expander("⚙️ คำนวณใหม่ทั้งหมด"):
+        st.caption("ใช้เมื่อแก้เกณฑ์ Score, แก้ข้อมูลย้อนหลัง หรือครั้งแรกหลังอัปเดตระบบ (log เก่ายังไม่ถูกนับ): ล้าง rollup แล้วคำนวณจาก practice_logs ใหม่ทั้งหมด")
+        if st.button("♻️ คำนวณใหม่", key="analytics_rebuild"):
+            with st.spinner("กำลังคำนวณ..."):
+                try:
+                    rollup.rebuild()
+                except Exception as e:
+                    st.error(f"❌ Error rebuilding analytics: {e}")
+            fetch_rollups.clear()
+            fetch_rollup_sources.clear()
+            st.rerun()
+
+def save_status_banner(log_id):
+    """แสดงสถานะการบันทึกผล (saved / pending) จากคิวเบื้องหลัง"""
+    save_state = get_log_writer().status(log_id) if log_id else None
+    if save_state == PracticeLogWriter.STATUS_SAVED:
+        st.success("✅ บันทึกข้อมูลการฝึกซ้อมลงในระบบเรียบร้อยแล้ว")
+    elif save_state == PracticeLogWriter.STATUS_JOURNALED:
+        st.warning("⚠️ ยังเชื่อมต่อฐานข้อมูลไม่ได้ ระบบเก็บผลไว้ชั่วคราวและจะบันทึกให้อัตโนมัติ")
+    elif save_state == PracticeLogWriter.STATUS_PENDING:
+        c1, c2 = st.columns([4, 1])
+        c1.info("⏳ กำลังบันทึกข้อมูลการฝึกซ้อม...")
+        if c2.button("🔄 ตรวจสอบสถานะ"):
+            st.rerun()
+    else:
+        st.error("❌ ไม่สามารถบันทึกข้อมูลได้")
+
 def feedback_page():
     st.title("📊 ผลการประเมิน")
-    st.success("✅ บันทึกข้อมูลการฝึกซ้อมลงในระบบเรียบร้อยแล้ว") 
+    save_status_banner(st.session_state.get('practice_log_id'))
+    scores = st.session_state.get('final_scores')
+    if scores:
+        st.metric("คะแนนเฉลี่ยรายทักษะ", f"{sum(s['score'] for s in scores) / len(scores):.2f} / 5")
     st.markdown(st.session_state.final_feedback)
     if st.button("กลับหน้าหลัก"):
         st.session_state.page = 'case_selection'
         st.session_state.final_feedback = None
+        st.session_state.final_scores = None
         st.session_state.current_case = None
+        st.session_state.practice_log_id = None
+        st.session_state.chat_session_id = None
+        st.query_params.pop("session", None)
         st.rerun()
 
+def resume_practice_session():
+    """
+    ถ้า URL มี ?session=<id> ของการซักประวัติที่ยังไม่จบ (เช่นเน็ตหลุด / redeploy)
+    โหลดผู้ใช้ เคส และบทสนทนาจาก Mongo แล้วกลับไปหน้าแชทต่อจากเดิม
+    """
+    session_id = st.query_params.get("session")
+    if not session_id or st.session_state.get('chat_session_id') == session_id:
+        return
+    try:
+        found = find_resumable_session(session_id)
+    except Exception:
+        return  # Mongo ไม่พร้อม: ไม่ resume (ลองใหม่เมื่อ reload)
+    if not found:
+        st.query_params.pop("session", None)
+        return
+    meta, turns = found
+    case = load_case(*meta["case_ref"])
+    if not case:
+        return
+
+    st.session_state.user = meta["user"]
+    st.session_state.current_case = case
+    st.session_state.current_case_ref = case.ref
+    st.session_state.owner_system_prompt = build_owner_prompt(case)
+    st.session_state.chat_history = turns
+    st.session_state.turn_metrics = []
+    st.session_state.chat_session = create_owner_chat(
+        st.session_state.owner_system_prompt, chat_history_to_model_history(turns)
+    )
+    st.session_state.chat_session_id = session_id
+    st.session_state.page = 'chat'
+    st.toast(f"↩️ กลับมาทำต่อจากเดิม ({len(turns)} ข้อความ)")
+
+def collect_metrics_text():
+    """รวม metrics ทั้งหมด (counter/histogram + gauge ของ pool/cache/คิวบันทึก) เป็น Prometheus text"""
+    gauges = {f"vet_app_mongo_pool_{k}": v for k, v in get_pool_stats().snapshot().items()}
+    gauges.update({f"vet_app_evaluation_cache_{k}": v for k, v in get_evaluation_cache().stats().items()})
+    gauges["vet_app_log_writer_queue_size"] = get_log_writer().pending_count()
+    gauges.update({f"vet_app_gemini_scheduler_{k}": v for k, v in get_gemini_scheduler().stats().items()})
+    return get_metrics().render_prometheus(gauges)
+
+def metrics_page_requested():
+    """หน้า metrics เปิดด้วย ?metrics=<ADMIN_TOKEN> เท่านั้น (ไม่ได้ตั้ง ADMIN_TOKEN = ปิดหน้านี้)"""
+    token = st.query_params.get("metrics")
+    admin_token = get_secret("ADMIN_TOKEN")
+    if token is None or not admin_token: return False
+    return hmac.compare_digest(token, admin_token)
+
+def metrics_page():
+    st.title("📈 Metrics")
+    st.caption("latency ของ Gemini / Mongo, จำนวน token, error และ cache (ตั้งแต่ process เริ่มทำงาน)")
+    st.dataframe(get_metrics().summary(), use_container_width=True)
+    metrics_text = collect_metrics_text()
+    st.download_button("⬇️ ดาวน์โหลด (Prometheus text)", metrics_text, file_name="metrics.txt")
+    st.code(metrics_text, language="text")
+
+def debug_sidebar():
+    """แสดงสถิติ Connection Pool / cache ผลประเมิน ใน sidebar (เปิดด้วย ?debug=1)"""
+    if st.query_params.get("debug") != "1": return
+    with st.sidebar.expander("🔧 MongoDB Pool", expanded=False):
+        st.json(get_pool_stats().snapshot())
+    with st.sidebar.expander("🗃️ Evaluation cache", expanded=False):
+        st.json(get_evaluation_cache().stats())
+    with st.sidebar.expander("🧩 Prompt contexts", expanded=False):
+        registry = get_context_registry()
+        current = registry.get()
+        st.json({"version": current.version, "compiles": registry.compiles})
+    if CACHE_INVALIDATION_ENABLED:
+        with st.sidebar.expander("♻️ Cache invalidation", expanded=False):
+            invalidator = start_cache_invalidator()
+            st.json({"modes": invalidator.modes, "errors": invalidator.errors, "events": invalidator.events})
+    with st.sidebar.expander("🔥 Warm-up", expanded=False):
+        warmup = get_warmup()
+        st.json({"status": warmup.status, "step_ms": warmup.steps, "errors": warmup.errors})
+
 # ==============================================================================
 # 5. MAIN APP (UPDATED)
 # ==============================================================================
 
 if 'page' not in st.session_state: st.session_state.page = 'login'
 if 'chat_history' not in st.session_state: st.session_state.chat_history = []
+if 'turn_metrics' not in st.session_state: st.session_state.turn_metrics = []
+resume_practice_session()
 if 'user' not in st.session_state and st.session_state.page != 'login':
     st.session_state.page = 'login'
 
 if __name__ == "__main__":
-    # โหลดข้อมูลต่างๆ
-    gvcccm_data = fetch_gvcccm_data()
-    score_stages = fetch_score_checklist()
-    items = fetch_case_scenario() # โหลดเคสจาก Mongo
+    # หน้า login ไม่แตะ Mongo/Gemini เลย: หน้าอื่นๆ เริ่ม warm-up (ครั้งเดียวต่อ process) แล้วโหลดข้อมูลเมื่อใช้จริง
+    if st.session_state.page != 'login':
+        get_warmup().start()
+        # เฝ้าดูการแก้ไขเคส/เกณฑ์ไม่ขึ้นกับ WARMUP: cache เคสมีอายุหลายชั่วโมง ต้องมีตัว invalidate เสมอ
+        if CACHE_INVALIDATION_ENABLED and get_secret("MONGODB_URI", section="mongo"):
+            start_cache_invalidator()
     
-    ctx_gvcccm = create_gvcccm_context(gvcccm_data) if gvcccm_data else ""
-    ctx_score = create_score_context(score_stages) if score_stages else ""
+    debug_sidebar()
+    if METRICS_PORT:
+        try:
+            start_metrics_server(METRICS_PORT)
+        except OSError:
+            pass  # port ถูกใช้แล้ว (เช่นมีหลาย process)
     
     # เพิ่ม Logic การเปลี่ยนหน้า case_detail
-    if st.session_state.page == 'login': login_page()
+    if metrics_page_requested(): metrics_page()
+    elif st.session_state.page == 'login': login_page()
     elif st.session_state.page == 'case_selection': case_selection_page()
     elif st.session_state.page == 'case_detail': case_detail_page() # <-- หน้าใหม่ที่เพิ่มเข้ามา
-    elif st.session_state.page == 'chat': chat_page(ctx_gvcccm, ctx_score)
+    elif st.session_state.page == 'chat':
+        contexts = get_context_registry().get() # prompt context ที่คอมไพล์ไว้แล้ว
+        chat_page(contexts.gvcccm, contexts.score, contexts.skills)
     elif st.session_state.page == 'feedback': feedback_page()
+    elif st.session_state.page == 'batch_grading': batch_grading_page(get_context_registry().get())
+    elif st.session_state.page == 'analytics': analytics_page()
 
 
 
@@ -0,0 +1,164 @@
+"""
+ตัวแทน Gemini / MongoDB สำหรับ benchmark แบบ offline (ไม่ใช้ API quota / ไม่แตะ cluster จริง)
+
+- FakeGenerativeModel: แทน genai.GenerativeModel ตั้ง latency / streaming ได้ผ่าน FAKE_GEMINI
+- mongo_client_factory(): แทน pymongo.MongoClient ด้วย mongomock ที่แชร์ข้อมูลกันทั้ง process
+  และนับจำนวนครั้งที่ถูกสร้าง (ใช้จับ regression แบบสร้าง client ใหม่ทุก call)
+"""
+import json
+import threading
+import time
+from types import SimpleNamespace
+
+from bson import ObjectId
+
+# ค่าตั้งต้นของ Gemini ปลอม (ปรับได้จาก load_test.py)
+FAKE_GEMINI = {
+    "first_token_latency": 0.3,   # วินาทีก่อนได้ chunk แรก
+    "chunk_latency": 0.05,        # วินาทีระหว่าง chunk
+    "chunks": 8,                  # จำนวน chunk ต่อคำตอบ
+}
+
+OWNER_REPLY = "น้องซึมมาสองวันแล้วค่ะ กินข้าวน้อยลง "
+EVALUATION_REPLY = (
+    "1. คะแนนรายทักษะ\n- ทักทายและแนะนำตัว: 4/5\n- ถามคำถามปลายเปิด: 3/5\n"
+    "2. สรุปภาพรวม\nซักประวัติได้ครบถ้วนพอสมควร\n"
+    "3. ข้อเสนอแนะ\nควรสรุปข้อมูลกับเจ้าของก่อนจบ"
+)
+
+
+def _structured_evaluation(schema):
+    """ผลประเมินแบบ JSON ตาม response_schema (ให้คะแนนทุกทักษะใน enum)"""
+    skills = schema["properties"]["skills"]["items"]["properties"]["skill"].get("enum", []) if schema else []
+    return json.dumps({
+        "skills": [{"skill": skill, "score": 3 + i % 3, "reason": "ถามได้ตรงประเด็น"} for i, skill in enumerate(skills)],
+        "summary": "ซักประวัติได้ครบถ้วนพอสมควร",
+        "suggestions": ["ควรสรุปข้อมูลกับเจ้าของก่อนจบ"],
+    }, ensure_ascii=False)
+
+
+def _usage(prompt_text, reply_text):
+    return SimpleNamespace(
+        prompt_token_count=len(prompt_text) // 3 + 1,
+        candidates_token_count=len(reply_text) // 3 + 1,
+    )
+
+
+class FakeResponse:
+    """คำตอบแบบครบทีเดียว / แบบ stream (iterate ได้เหมือน GenerateContentResponse)"""
+
+    def __init__(self, reply, prompt_text, stream):
+        self._reply = reply
+        self._stream = stream
+        self.usage_metadata = _usage(prompt_text, reply)
+        if not stream:
+            time.sleep(FAKE_GEMINI["first_token_latency"] + FAKE_GEMINI["chunk_latency"] * FAKE_GEMINI["chunks"])
+
+    @property
+    def text(self):
+        return self._reply
+
+    def __iter__(self):
+        if not self._stream:
+            yield self
+            return
+        chunks = max(FAKE_GEMINI["chunks"], 1)
+        size = max(len(self._reply) // chunks, 1)
+        time.sleep(FAKE_GEMINI["first_token_latency"])
+        for i in range(0, len(self._reply), size):
+            yield SimpleNamespace(text=self._reply[i:i + size])
+            time.sleep(FAKE_GEMINI["chunk_latency"])
+
+
+class FakeChatSession:
+    def __init__(self, model, history):
+        self.model = model
+        self.history = list(history or [])
+
+    def send_message(self, prompt, stream=False):
+        response = self.model.generate_content(prompt, stream=stream)
+        self.history.append({"role": "user", "parts": [prompt]})
+        self.history.append({"role": "model", "parts": [response.text]})
+        return response
+
+
+class FakeGenerativeModel:
+    """แทน genai.GenerativeModel: ตอบเป็นเจ้าของสัตว์ หรือเป็นผลประเมิน ตาม system instruction"""
+
+    def __init__(self, model_name=None, system_instruction=None, generation_config=None, **kwargs):
+        self.model_name = model_name
+        self.system_instruction = system_instruction or ""
+        self.generation_config = generation_config
+
+    def generate_content(self, contents, stream=False, **kwargs):
+        prompt_text = self.system_instruction + str(contents)
+        config = self.generation_config or {}
+        if config.get("response_mime_type") == "application/json":
+            reply = _structured_evaluation(config.get("response_schema"))
+        elif "ประเมิน" in self.system_instruction:
+            reply = EVALUATION_REPLY
+        else:
+            reply = OWNER_REPLY * 3
+        return FakeResponse(reply, prompt_text, stream)
+
+    def start_chat(self, history=None):
+        return FakeChatSession(self, history)
+
+
+# --- MongoDB ---
+_mongo_lock = threading.Lock()
+_mongo_state = {"client": None, "created": 0}
+
+
+def mongo_client_factory(*args, **kwargs):
+    """แทน pymongo.MongoClient: คืน mongomock client ตัวเดียวกันเสมอ แต่นับจำนวนครั้งที่ถูกเรียก"""
+    import mongomock
+
+    with _mongo_lock:
+        _mongo_state["created"] += 1
+        if _mongo_state["client"] is None:
+            _mongo_state["client"] = mongomock.MongoClient()
+        return _mongo_state["client"]
+
+
+def mongo_clients_created():
+    return _mongo_state["created"]
+
+
+def seed_database(client, case_count=40):
+    """ใส่ข้อมูลเคส / GVCCCM Step / Score ตัวอย่าง"""
+    cases = client["case_scenario"]["dog"]
+    cases.delete_many({})
+    cases.insert_many([
+        {
+            "_id": ObjectId(),
+            "case_name": f"Case {i:03d}",
+            "owner_role": {
+                "pet_name": f"น้องหมา {i}",
+                "pet_details": "สุนัขพันธุ์ผสม อายุ 5 ปี ซึม เบื่ออาหาร อาเจียน 2 ครั้ง",
+                "role_th": "เจ้าของที่เป็นห่วงสัตว์เลี้ยงมาก",
+                "personality_tone": "กังวล พูดเร็ว",
+            },
+        }
+        for i in range(case_count)
+    ])
+
+    steps = client["GVCCCM"]["Step"]
+    steps.delete_many({})
+    steps.insert_many([
+        {"step_number": n, "step_name_th": f"ขั้นตอนที่ {n}", "summary_detail": "รายละเอียดขั้นตอน"}
+        for n in range(1, 6)
+    ])
+
+    score = client["GVCCCM"]["Score"]
+    score.delete_many({})
+    score.insert_one({
+        "checklist_name": "Calgary-Cambridge Consultation Communication Skills List",
+        "assessment_stages": [
+            {
+                "stage_name_th": f"ช่วงที่ {s}",
+                "skills": [{"skill_item": f"ทักษะ {s}.{k}"} for k in range(1, 4)],
+            }
+            for s in range(1, 4)
+        ],
+    })
@@ -0,0 +1,251 @@
+"""
+Load test แบบ offline: จำลองนักศึกษา N คนพร้อมกัน เดินตาม flow จริงของแอปด้วย Streamlit AppTest
+login -> case_selection -> case_detail -> chat -> final_evaluation (feedback)
+
+Gemini ถูกแทนด้วย benchmarks/fakes.py (ตั้ง latency/streaming ได้) และ MongoDB ใช้ mongomock
+(หรือ mongod ในเครื่องด้วย --mongo-uri) จึงไม่เปลือง API quota และไม่แตะ cluster จริง
+
+วิธีใช้ (จาก root ของ repo):
+    pip install -r benchmarks/requirements.txt
+    python -m benchmarks.load_test --students 20 --turns 5
+    python -m benchmarks.load_test --students 50 --no-stream --first-token 0.8 --json
+
+นักศึกษาแต่ละคนรันใน process แยก (AppTest ไม่ thread-safe) แล้วรวมผลเป็นรายงานเดียว:
+p50/p95/p99 ของเวลา run แต่ละหน้า, throughput, memory ต่อ session
+(วัดหลังอุ่นเครื่องหนึ่งรอบใน process เดียวกัน จึงไม่รวม import/cache ระดับ process)
+และจำนวน MongoClient ที่ถูกสร้าง (ควรเป็น 1 ต่อ process)
+หมายเหตุ: cache / scheduler ของแอปจึงไม่ได้แชร์กันระหว่างนักศึกษาเหมือนบน server จริง
+"""
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor
+from unittest import mock
+
+from benchmarks import fakes
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+WARMUP_INDEX_OFFSET = 100000   # นักศึกษาอุ่นเครื่อง ใช้ชื่อ/คำถามไม่ชนกับคนที่วัดจริง
+
+
+def percentile(values, pct):
+    if not values: return 0.0
+    ordered = sorted(values)
+    index = min(int(round(pct / 100 * (len(ordered) - 1))), len(ordered) - 1)
+    return ordered[index]
+
+
+class StudentSession:
+    """นักศึกษาจำลองหนึ่งคน (หนึ่ง AppTest = หนึ่ง browser session)"""
+
+    def __init__(self, index, turns, timeout, streaming):
+        from streamlit.testing.v1 import AppTest
+
+        self.index = index
+        self.turns = turns
+        self.streaming = streaming
+        self.at = AppTest.from_file(APP_PATH, default_timeout=timeout)
+        self.timings = []   # [(ขั้นตอน, วินาที)]
+        self.error = None
+
+    def _run(self, step, action=None):
+        started = time.perf_counter()
+        if action is not None:
+            action.run()
+        else:
+            self.at.run()
+        self.timings.append((step, time.perf_counter() - started))
+        if self.at.exception:
+            raise RuntimeError(f"{step}: {self.at.exception[0].message}")
+
+    def _button(self, elements, label_prefix):
+        return next(b for b in elements if b.label.startswith(label_prefix))
+
+    def play(self):
+        try:
+            self._run("login")
+            self.at.text_input[0].input(f"student-{self.index:03d}")
+            self._run("case_selection", self._button(self.at.button, "เข้าสู่ระบบ").click())
+
+            case_buttons = [b for b in self.at.button if b.key and b.key.startswith("btn_")]
+            if not case_buttons:
+                raise RuntimeError("case_selection: no cases rendered")
+            pick = case_buttons[self.index % len(case_buttons)]
+            self._run("case_detail", pick.click())
+
+            self._run("chat", self._button(self.at.button, "🚀").click())
+            if not self.streaming:
+                self.at.sidebar.toggle[0].set_value(False)
+            for turn in range(self.turns):
+                # คำถามไม่ซ้ำกันระหว่างนักศึกษา เพื่อไม่ให้ชน evaluation cache
+                question = f"[{self.index}:{turn}] น้องมีอาการอย่างไรบ้างครับ"
+                self._run("chat_turn", self.at.chat_input[0].set_value(question))
+
+            self._run("final_evaluation", self._button(self.at.sidebar.button, "🛑").click())
+            if self.at.session_state["page"] != "feedback":
+                raise RuntimeError("final_evaluation: did not reach feedback page")
+        except Exception as e:
+            # repr: StopIteration ฯลฯ มี str() เป็นค่าว่าง
+            self.error = repr(e)
+        return self
+
+
+def _patches(args):
+    """แทน Gemini ด้วยตัวปลอม และ Mongo ด้วย mongomock (หรือนับ client ของ mongod จริง)"""
+    patches = [
+        mock.patch("google.generativeai.GenerativeModel", fakes.FakeGenerativeModel),
+        mock.patch("google.generativeai.configure", lambda **kwargs: None),
+    ]
+    if args.mongo_uri:
+        import pymongo
+        real_client = pymongo.MongoClient
+
+        def counting_client(*a, **kw):
+            fakes._mongo_state["created"] += 1
+            return real_client(*a, **kw)
+        patches.append(mock.patch("pymongo.MongoClient", counting_client))
+    else:
+        patches.append(mock.patch("pymongo.MongoClient", fakes.mongo_client_factory))
+    return patches
+
+
+def run_student(index, args):
+    """(ใน process ลูก) เล่นเป็นนักศึกษาหนึ่งคน คืนผลเป็น dict ที่ pickle ได้"""
+    fakes.FAKE_GEMINI.update({
+        "first_token_latency": args.first_token,
+        "chunk_latency": args.chunk_latency,
+        "chunks": args.chunks,
+    })
+    os.environ.setdefault("GEMINI_API_KEY", "benchmark-fake-key")
+    os.environ["PRACTICE_LOG_JOURNAL"] = os.path.join(tempfile.mkdtemp(), "journal.jsonl")
+    os.environ["MONGODB_URI"] = args.mongo_uri or "mongodb://benchmark.invalid"
+    if not args.mongo_uri:
+        # mongomock อยู่ใน memory ของแต่ละ process: seed ใหม่ทุก process
+        fakes.seed_database(fakes.mongo_client_factory(), args.cases)
+        fakes._mongo_state["created"] = 0
+
+    patches = _patches(args)
+    for p in patches:
+        p.start()
+    try:
+        # อุ่นเครื่องก่อนหนึ่งรอบ (ไม่นับผล): import streamlit/app/SDK และ cache ระดับ process
+        # ไม่ให้ไปปนใน memory ต่อ session
+        StudentSession(WARMUP_INDEX_OFFSET + index, args.turns, args.timeout, not args.no_stream).play()
+        gc.collect()
+        tracemalloc.start()
+        baseline = tracemalloc.get_traced_memory()[0]
+        session = StudentSession(index, args.turns, args.timeout, not args.no_stream).play()
+        gc.collect()
+        memory = tracemalloc.get_traced_memory()[0] - baseline
+        tracemalloc.stop()
+    finally:
+        for p in patches:
+            p.stop()
+    return {
+        "index": index,
+        "timings": session.timings,
+        "error": session.error,
+        "memory": memory,
+        "mongo_clients": fakes.mongo_clients_created(),
+    }
+
+
+def run_load_test(args):
+    if args.mongo_uri:
+        import pymongo
+        fakes.seed_database(pymongo.MongoClient(args.mongo_uri), args.cases)
+
+    # spawn: ทุก process เริ่มจาก import ว่าง (ไม่ fork state ของ Streamlit/thread มาด้วย)
+    context = multiprocessing.get_context("spawn")
+    started = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.concurrency or args.students, mp_context=context) as pool:
+        futures = [pool.submit(run_student, i, args) for i in range(args.students)]
+        results = []
+        for i, future in enumerate(futures):
+            try:
+                results.append(future.result())
+            except Exception as e:
+                results.append({"index": i, "timings": [], "error": repr(e), "memory": 0, "mongo_clients": 0})
+    wall = time.perf_counter() - started
+    return build_report(results, wall)
+
+
+def build_report(results, wall):
+    by_step = {}
+    for result in results:
+        for step, seconds in result["timings"]:
+            by_step.setdefault(step, []).append(seconds)
+    all_runs = [seconds for values in by_step.values() for seconds in values]
+    completed = [r for r in results if r["error"] is None]
+    memory_per_session = sum(r["memory"] for r in results) / max(len(results), 1)
+
+    def stats(values):
+        return {
+            "runs": len(values),
+            "p50_ms": round(percentile(values, 50) * 1000, 1),
+            "p95_ms": round(percentile(values, 95) * 1000, 1),
+            "p99_ms": round(percentile(values, 99) * 1000, 1),
+        }
+
+    return {
+        "students": len(results),
+        "completed": len(completed),
+        "errors": [f"student-{r['index']:03d}: {r['error']}" for r in results if r["error"] is not None],
+        "wall_seconds": round(wall, 2),
+        "throughput_sessions_per_s": round(len(completed) / wall, 3) if wall else 0.0,
+        "throughput_runs_per_s": round(len(all_runs) / wall, 2) if wall else 0.0,
+        "memory_per_session_kb": round(memory_per_session / 1024, 1),
+        # ต่อ process (ทุก process ควรสร้าง client แค่ 1 ตัว)
+        "mongo_clients_created": max((r["mongo_clients"] for r in results), default=0),
+        "overall": stats(all_runs),
+        "steps": {step: stats(values) for step, values in by_step.items()},
+    }
+
+
+def print_report(report):
+    print(f"students: {report['completed']}/{report['students']} completed in {report['wall_seconds']} s")
+    print(f"throughput: {report['throughput_sessions_per_s']} sessions/s, {report['throughput_runs_per_s']} runs/s")
+    print(f"memory per session: ~{report['memory_per_session_kb']} KiB")
+    print(f"MongoClient constructions (max per process): {report['mongo_clients_created']}")
+    print(f"{'step':<18}{'runs':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for step, row in list(report["steps"].items()) + [("overall", report["overall"])]:
+        print(f"{step:<18}{row['runs']:>6}{row['p50_ms']:>10}{row['p95_ms']:>10}{row['p99_ms']:>10}")
+    for error in report["errors"]:
+        print(f"ERROR {error}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load test for the vet learning app")
+    parser.add_argument("--students", type=int, default=10, help="จำนวนนักศึกษาจำลอง")
+    parser.add_argument("--concurrency", type=int, default=0, help="จำนวนที่รันพร้อมกัน (0 = เท่ากับ --students)")
+    parser.add_argument("--turns", type=int, default=5, help="จำนวนคำถามต่อคน")
+    parser.add_argument("--cases", type=int, default=40, help="จำนวนเคสตัวอย่างในฐานข้อมูล")
+    parser.add_argument("--first-token", type=float, default=0.3, help="latency ก่อน token แรกของ Gemini ปลอม (วินาที)")
+    parser.add_argument("--chunk-latency", type=float, default=0.05, help="latency ระหว่าง chunk (วินาที)")
+    parser.add_argument("--chunks", type=int, default=8, help="จำนวน chunk ต่อคำตอบ")
+    parser.add_argument("--no-stream", action="store_true", help="ปิดโหมด streaming ในหน้าแชท")
+    parser.add_argument("--mongo-uri", default=None, help="ใช้ mongod ในเครื่องแทน mongomock")
+    parser.add_argument("--timeout", type=float, default=60, help="timeout ต่อการ run หนึ่งครั้ง (วินาที)")
+    parser.add_argument("--json", action="store_true", help="พิมพ์รายงานเป็น JSON")
+    parser.add_argument("--max-mongo-clients", type=int, default=1,
+                        help="exit 1 ถ้าสร้าง MongoClient มากกว่านี้ (จับ regression)")
+    args = parser.parse_args(argv)
+
+    report = run_load_test(args)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+    failed = report["completed"] < report["students"] or report["mongo_clients_created"] > args.max_mongo_clients
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
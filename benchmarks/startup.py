@@ -0,0 +1,139 @@
+"""
+วัดเวลา cold start: import SDK แต่ละตัว และเวลา render หน้าแรก (login) ของ app.py ใน process ใหม่ทุกครั้ง
+ใช้ตรวจว่าหน้า login ไม่ import pymongo / google.generativeai และไม่แตะ Mongo/Gemini
+
+วิธีใช้ (จาก root ของ repo):
+    pip install -r benchmarks/requirements.txt
+    python -m benchmarks.startup --runs 5
+    python -m benchmarks.startup --runs 5 --login --json
+
+--login: กดเข้าสู่ระบบต่อหลัง render แรก (ใช้ Gemini ปลอม + mongomock จาก benchmarks/fakes.py)
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+APP_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app.py")
+HEAVY_MODULES = ["streamlit", "pymongo", "google.generativeai"]
+
+
+def _run_child(args):
+    """รันตัวเองใน process ใหม่ (import cache ว่าง) แล้วอ่านผล JSON บรรทัดสุดท้าย"""
+    output = subprocess.run(
+        [sys.executable, "-m", "benchmarks.startup"] + args,
+        check=True, capture_output=True, text=True,
+        cwd=os.path.dirname(APP_PATH),   # root ของ repo (ให้ import benchmarks ได้)
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def child_import(module):
+    started = time.perf_counter()
+    __import__(module)
+    print(json.dumps({"seconds": time.perf_counter() - started}))
+
+
+def child_render(login):
+    from unittest import mock
+
+    os.environ.setdefault("GEMINI_API_KEY", "benchmark-fake-key")
+    started = time.perf_counter()
+    from streamlit.testing.v1 import AppTest
+    result = {"streamlit_import": time.perf_counter() - started}
+
+    at = AppTest.from_file(APP_PATH, default_timeout=60)
+    started = time.perf_counter()
+    at.run()
+    result["first_render"] = time.perf_counter() - started
+    if at.exception:
+        raise SystemExit(f"first render failed: {at.exception[0].message}")
+    # หน้า login ไม่ควรโหลด SDK หนักๆ
+    result["loaded_after_first_render"] = [m for m in HEAVY_MODULES[1:] if m in sys.modules]
+
+    if login:
+        from benchmarks import fakes
+
+        os.environ["MONGODB_URI"] = "mongodb://benchmark.invalid"
+        os.environ["PRACTICE_LOG_JOURNAL"] = os.path.join(tempfile.mkdtemp(), "journal.jsonl")
+        fakes.seed_database(fakes.mongo_client_factory())
+        with mock.patch("pymongo.MongoClient", fakes.mongo_client_factory), \
+                mock.patch("google.generativeai.GenerativeModel", fakes.FakeGenerativeModel), \
+                mock.patch("google.generativeai.configure", lambda **kwargs: None):
+            at.text_input[0].input("startup-benchmark")
+            submit = next(b for b in at.button if b.label.startswith("เข้าสู่ระบบ"))
+            started = time.perf_counter()
+            submit.click().run()
+            result["login_to_case_selection"] = time.perf_counter() - started
+            if at.exception:
+                raise SystemExit(f"login failed: {at.exception[0].message}")
+    print(json.dumps(result))
+
+
+def summarize(values):
+    ms = [v * 1000 for v in values]
+    return {
+        "median_ms": round(statistics.median(ms), 1),
+        "min_ms": round(min(ms), 1),
+        "max_ms": round(max(ms), 1),
+    }
+
+
+def run_benchmark(args):
+    report = {"runs": args.runs, "imports": {}, "render": {}}
+    for module in HEAVY_MODULES:
+        samples = [_run_child(["--child-import", module])["seconds"] for _ in range(args.runs)]
+        report["imports"][module] = summarize(samples)
+
+    renders = [_run_child(["--child-render"] + (["--login"] if args.login else [])) for _ in range(args.runs)]
+    for key in ("streamlit_import", "first_render", "login_to_case_selection"):
+        samples = [r[key] for r in renders if key in r]
+        if samples:
+            report["render"][key] = summarize(samples)
+    report["loaded_after_first_render"] = sorted({m for r in renders for m in r["loaded_after_first_render"]})
+    return report
+
+
+def print_report(report):
+    print(f"runs: {report['runs']} (fresh process each)")
+    print(f"{'measurement':<28}{'median ms':>12}{'min ms':>10}{'max ms':>10}")
+    for name, row in list(report["imports"].items()) + list(report["render"].items()):
+        print(f"{name:<28}{row['median_ms']:>12}{row['min_ms']:>10}{row['max_ms']:>10}")
+    loaded = report["loaded_after_first_render"]
+    print(f"heavy modules loaded by login page: {', '.join(loaded) if loaded else 'none'}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Cold-start benchmark for the vet learning app")
+    parser.add_argument("--runs", type=int, default=3, help="จำนวนรอบ (process ใหม่ทุกรอบ)")
+    parser.add_argument("--login", action="store_true", help="วัดเวลากดเข้าสู่ระบบ -> หน้าเลือกเคสด้วย")
+    parser.add_argument("--json", action="store_true", help="พิมพ์รายงานเป็น JSON")
+    parser.add_argument("--max-first-render-ms", type=float, default=0,
+                        help="exit 1 ถ้า median ของ first render เกินค่านี้ (0 = ไม่ตรวจ)")
+    parser.add_argument("--child-import", help=argparse.SUPPRESS)
+    parser.add_argument("--child-render", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child_import:
+        child_import(args.child_import)
+        return 0
+    if args.child_render:
+        child_render(args.login)
+        return 0
+
+    report = run_benchmark(args)
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+    else:
+        print_report(report)
+
+    slow = args.max_first_render_ms and report["render"]["first_render"]["median_ms"] > args.max_first_render_ms
+    return 1 if slow or report["loaded_after_first_render"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,79 @@
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("streamlit")
+pytest.importorskip("bson")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+
+import app  # noqa: E402
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """เวลาที่เลื่อนเองได้ (EvaluationCache ใช้ time.time())"""
+    now = {"t": 1_000_000.0}
+    monkeypatch.setattr(app.time, "time", lambda: now["t"])
+    return now
+
+
+def test_get_returns_stored_text_and_counts_hits(clock):
+    cache = app.EvaluationCache(ttl=60, max_entries=10, use_mongo=False)
+    assert cache.get("a") is None
+    cache.put("a", "feedback")
+    assert cache.get("a") == "feedback"
+    stats = cache.stats()
+    assert (stats["memory_hits"], stats["misses"], stats["hit_ratio"]) == (1, 1, 0.5)
+
+
+def test_entries_expire_after_ttl(clock):
+    cache = app.EvaluationCache(ttl=60, max_entries=10, use_mongo=False)
+    cache.put("a", "feedback")
+    clock["t"] += 59
+    assert cache.get("a") == "feedback"
+    clock["t"] += 2
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_evicts_least_recently_used(clock):
+    cache = app.EvaluationCache(ttl=60, max_entries=2, use_mongo=False)
+    cache.put("a", "A")
+    cache.put("b", "B")
+    assert cache.get("a") == "A"   # a ถูกใช้ล่าสุด -> b เก่าสุด
+    cache.put("c", "C")
+    assert cache.get("b") is None
+    assert cache.get("a") == "A" and cache.get("c") == "C"
+    assert cache.stats()["evictions"] == 1
+
+
+def test_put_refreshes_existing_entry(clock):
+    cache = app.EvaluationCache(ttl=60, max_entries=2, use_mongo=False)
+    cache.put("a", "old")
+    clock["t"] += 50
+    cache.put("a", "new")
+    clock["t"] += 50
+    assert cache.get("a") == "new"
+    assert cache.stats()["entries"] == 1
+
+
+def test_mongo_tier_fills_memory_on_hit(clock, monkeypatch):
+    cache = app.EvaluationCache(ttl=60, max_entries=10, use_mongo=True)
+    calls = []
+    monkeypatch.setattr(cache, "_mongo_get", lambda key: calls.append(key) or "from mongo")
+    assert cache.get("a") == "from mongo"
+    assert cache.get("a") == "from mongo"
+    assert calls == ["a"]
+    stats = cache.stats()
+    assert (stats["mongo_hits"], stats["memory_hits"]) == (1, 1)
+
+
+def test_cache_key_depends_on_model_instruction_and_transcript():
+    key = app.evaluation_cache_key("m", "instruction", "transcript")
+    assert key == app.evaluation_cache_key("m", "instruction", "transcript")
+    assert key != app.evaluation_cache_key("m2", "instruction", "transcript")
+    assert key != app.evaluation_cache_key("m", "instruction2", "transcript")
+    assert key != app.evaluation_cache_key("m", "instruction", "transcript2")
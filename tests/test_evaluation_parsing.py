@@ -0,0 +1,147 @@
+import json
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("streamlit")
+pytest.importorskip("bson")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+
+import app  # noqa: E402
+
+SKILLS = (
+    ("ช่วงที่ 1", "ทักทายและแนะนำตัว"),
+    ("ช่วงที่ 1", "ถามคำถามปลายเปิด"),
+    ("ช่วงที่ 2", "สรุปข้อมูลกับเจ้าของ"),
+)
+
+
+def evaluation_json(**overrides):
+    data = {
+        "skills": [
+            {"skill": "ทักทายและแนะนำตัว", "score": 4, "reason": "แนะนำตัวชัดเจน"},
+            {"skill": "ถามคำถามปลายเปิด", "score": 3, "reason": ""},
+            {"skill": "สรุปข้อมูลกับเจ้าของ", "score": 2, "reason": "ยังไม่สรุป"},
+        ],
+        "summary": "ซักประวัติได้ครบถ้วนพอสมควร",
+        "suggestions": ["ควรสรุปข้อมูลก่อนจบ"],
+    }
+    data.update(overrides)
+    return json.dumps(data, ensure_ascii=False)
+
+
+def test_parse_evaluation_accepts_complete_response():
+    evaluation = app.parse_evaluation(evaluation_json(), SKILLS)
+    assert [s["score"] for s in evaluation["skills"]] == [4, 3, 2]
+    assert evaluation["skills"][2]["stage"] == "ช่วงที่ 2"
+    assert evaluation["summary"] == "ซักประวัติได้ครบถ้วนพอสมควร"
+    assert app.evaluation_scores(evaluation)[0] == {"stage": "ช่วงที่ 1", "skill": "ทักทายและแนะนำตัว", "score": 4}
+
+
+def test_parse_evaluation_strips_code_fence_and_keeps_checklist_order():
+    data = json.loads(evaluation_json())
+    data["skills"].reverse()
+    evaluation = app.parse_evaluation("```json\n" + json.dumps(data, ensure_ascii=False) + "\n```", SKILLS)
+    assert [s["skill"] for s in evaluation["skills"]] == [skill for _, skill in SKILLS]
+
+
+@pytest.mark.parametrize("key", ["skills", "summary", "suggestions"])
+def test_parse_evaluation_rejects_missing_keys(key):
+    data = json.loads(evaluation_json())
+    del data[key]
+    with pytest.raises(ValueError, match=key):
+        app.parse_evaluation(json.dumps(data, ensure_ascii=False), SKILLS)
+
+
+@pytest.mark.parametrize("score", [4.9, "4", True, None, 0, 6])
+def test_parse_evaluation_rejects_invalid_scores(score):
+    data = json.loads(evaluation_json())
+    data["skills"][0]["score"] = score
+    with pytest.raises(ValueError, match="score"):
+        app.parse_evaluation(json.dumps(data, ensure_ascii=False), SKILLS)
+
+
+def test_parse_evaluation_accepts_integral_float_score():
+    data = json.loads(evaluation_json())
+    data["skills"][0]["score"] = 4.0
+    evaluation = app.parse_evaluation(json.dumps(data, ensure_ascii=False), SKILLS)
+    assert evaluation["skills"][0]["score"] == 4
+
+
+def test_parse_evaluation_rejects_incomplete_coverage():
+    data = json.loads(evaluation_json())
+    data["skills"] = data["skills"][:1]
+    with pytest.raises(ValueError, match="missing scores for 2 of 3"):
+        app.parse_evaluation(json.dumps(data, ensure_ascii=False), SKILLS)
+
+
+def test_parse_evaluation_rejects_unknown_and_duplicate_skills():
+    data = json.loads(evaluation_json())
+    data["skills"][1]["skill"] = "ตรวจร่างกาย"
+    with pytest.raises(ValueError, match="unknown skill"):
+        app.parse_evaluation(json.dumps(data, ensure_ascii=False), SKILLS)
+
+    data = json.loads(evaluation_json())
+    data["skills"].append(dict(data["skills"][0]))
+    with pytest.raises(ValueError, match="duplicate skill"):
+        app.parse_evaluation(json.dumps(data, ensure_ascii=False), SKILLS)
+
+
+def test_parse_evaluation_rejects_non_json():
+    with pytest.raises(ValueError):
+        app.parse_evaluation("1. คะแนนรายทักษะ\n- ทักทายและแนะนำตัว: 4/5", SKILLS)
+
+
+FEEDBACK = (
+    "1. คะแนนรายทักษะ\n"
+    "- **ทักทายและแนะนำตัว**: 4/5\n"
+    "- ถามคำถามปลายเปิด: 3/5\n"
+    "* สรุปข้อมูลกับเจ้าของ — คะแนน: 2 (ควรปรับ)\n"
+    "2. สรุปภาพรวม\n"
+    "สุนัขอายุ 5 ปี"
+)
+
+
+def test_extract_skill_scores_matches_checklist():
+    scores = app.extract_skill_scores(FEEDBACK, SKILLS)
+    assert scores == [
+        {"stage": "ช่วงที่ 1", "skill": "ทักทายและแนะนำตัว", "score": 4},
+        {"stage": "ช่วงที่ 1", "skill": "ถามคำถามปลายเปิด", "score": 3},
+        {"stage": "ช่วงที่ 2", "skill": "สรุปข้อมูลกับเจ้าของ", "score": 2},
+    ]
+
+
+def test_extract_skill_scores_without_checklist_uses_labels():
+    scores = app.extract_skill_scores(FEEDBACK)
+    assert [s["skill"] for s in scores] == ["ทักทายและแนะนำตัว", "ถามคำถามปลายเปิด", "สรุปข้อมูลกับเจ้าของ"]
+    assert all(s["stage"] is None for s in scores)
+
+
+def test_extract_skill_scores_ignores_unknown_skills_and_empty_text():
+    assert app.extract_skill_scores("- ตรวจร่างกาย: 5/5", SKILLS) == []
+    assert app.extract_skill_scores(None, SKILLS) == []
+    assert app.score_fields([]) == {"scores": [], "score_avg": None}
+
+
+def test_evaluate_transcript_falls_back_to_free_text_when_repair_fails(monkeypatch):
+    calls = []
+
+    def generate(conversation_history, history_text, system_instruction, score_context, generation_config=None):
+        calls.append(generation_config)
+        return '{"skills": []}' if generation_config else FEEDBACK
+
+    monkeypatch.setattr(app, "EVAL_STRUCTURED", True)
+    monkeypatch.setattr(app, "get_evaluation_cache", lambda: app.EvaluationCache(60, 10, False))
+    monkeypatch.setattr(app, "_generate_evaluation", generate)
+    monkeypatch.setattr(app, "_repair_evaluation", lambda raw_text, error, skills: '{"summary": "x"}')
+
+    history = [{"role": "user", "content": "สวัสดีครับ"}]
+    feedback_text, evaluation, from_cache = app.evaluate_transcript(history, "", "", SKILLS)
+
+    assert evaluation is None and not from_cache
+    assert feedback_text == FEEDBACK
+    assert calls[0] is not None and calls[1] is None
+    assert [s["score"] for s in app.extract_skill_scores(feedback_text, SKILLS)] == [4, 3, 2]
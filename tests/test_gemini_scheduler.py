@@ -0,0 +1,133 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("streamlit")
+pytest.importorskip("bson")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+
+import app  # noqa: E402
+
+
+@pytest.fixture
+def scheduler(monkeypatch):
+    # rpm สูงพอที่ token bucket จะไม่เป็นตัวจำกัด ทดสอบเฉพาะคิว/จำนวนพร้อมกัน
+    s = app.GeminiScheduler(rpm=60000, max_concurrency=1)
+    monkeypatch.setattr(app, "get_gemini_scheduler", lambda: s)
+    return s
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.005)
+
+
+def start_waiter(scheduler, lane, order):
+    def run():
+        release = scheduler.acquire(lane)
+        order.append(lane)
+        release()
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_concurrency_cap_blocks_until_release(scheduler):
+    release = scheduler.acquire(app.LANE_INTERACTIVE)
+    order = []
+    waiter = start_waiter(scheduler, app.LANE_INTERACTIVE, order)
+    wait_until(lambda: scheduler.stats()["queued"] == 1)
+    time.sleep(0.05)
+    assert order == [] and scheduler.stats()["active"] == 1
+
+    release()
+    waiter.join(5)
+    assert order == [app.LANE_INTERACTIVE]
+    assert scheduler.stats() | {"tokens": 0} == {"active": 0, "queued": 0, "tokens": 0, "retries": 0, "throttled": 0}
+
+
+def test_interactive_lane_goes_before_earlier_batch_requests(scheduler):
+    release = scheduler.acquire(app.LANE_BATCH)
+    order = []
+    batch = start_waiter(scheduler, app.LANE_BATCH, order)
+    wait_until(lambda: scheduler.stats()["queued"] == 1)
+    interactive = start_waiter(scheduler, app.LANE_INTERACTIVE, order)
+    wait_until(lambda: scheduler.stats()["queued"] == 2)
+
+    release()
+    batch.join(5)
+    interactive.join(5)
+    assert order == [app.LANE_INTERACTIVE, app.LANE_BATCH]
+
+
+def test_same_lane_is_first_come_first_served(scheduler):
+    release = scheduler.acquire(app.LANE_BATCH)
+    order, threads = [], []
+    for i in range(3):
+        def run(i=i):
+            r = scheduler.acquire(app.LANE_BATCH)
+            order.append(i)
+            r()
+        threads.append(threading.Thread(target=run, daemon=True))
+        threads[-1].start()
+        wait_until(lambda: scheduler.stats()["queued"] == i + 1)
+
+    release()
+    for thread in threads:
+        thread.join(5)
+    assert order == [0, 1, 2]
+
+
+def test_release_is_idempotent(scheduler):
+    release = scheduler.acquire(app.LANE_INTERACTIVE)
+    release()
+    release()
+    assert scheduler.stats()["active"] == 0
+
+
+def test_call_gemini_releases_on_error(scheduler):
+    def failing():
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        app.call_gemini("test", failing)
+    assert scheduler.stats()["active"] == 0
+
+
+def test_call_gemini_holds_slot_until_stream_is_consumed(scheduler):
+    stream = app.call_gemini("test", lambda: iter(["a", "b"]), stream=True)
+    assert scheduler.stats()["active"] == 1
+    assert list(stream) == ["a", "b"]
+    assert scheduler.stats()["active"] == 0
+
+
+def test_call_gemini_releases_when_stream_is_closed_early(scheduler):
+    stream = app.call_gemini("test", lambda: iter(["a", "b"]), stream=True)
+    assert next(stream) == "a"
+    stream.close()
+    assert scheduler.stats()["active"] == 0
+
+
+def test_call_gemini_releases_when_stream_is_closed_before_reading(scheduler):
+    stream = app.call_gemini("test", lambda: iter(["a", "b"]), stream=True)
+    stream.close()
+    assert scheduler.stats()["active"] == 0
+
+
+def test_call_gemini_releases_when_stream_raises(scheduler):
+    def broken():
+        yield "a"
+        raise RuntimeError("connection reset")
+
+    stream = app.call_gemini("test", broken, stream=True)
+    with pytest.raises(RuntimeError):
+        list(stream)
+    assert scheduler.stats()["active"] == 0
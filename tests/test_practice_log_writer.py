@@ -0,0 +1,137 @@
+import os
+import sys
+
+import pytest
+
+pytest.importorskip("streamlit")
+pytest.importorskip("bson")
+mongomock = pytest.importorskip("mongomock")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("GEMINI_API_KEY", "test-key")
+
+import app  # noqa: E402
+from bson import ObjectId, json_util  # noqa: E402
+
+COLLECTION = app.LOG_COLLECTION_NAME
+
+
+@pytest.fixture
+def mongo(monkeypatch):
+    """สลับ Mongo ขึ้น/ลงได้ระหว่าง test: state["up"] = False -> get_mongo_client() คืน None"""
+    client = mongomock.MongoClient()
+    state = {"up": False}
+    monkeypatch.setattr(app, "get_mongo_client", lambda: client if state["up"] else None)
+    state["client"] = client
+    return state
+
+
+@pytest.fixture
+def writer(tmp_path, mongo):
+    w = app.PracticeLogWriter(str(tmp_path / "journal.jsonl"), batch_size=2, flush_interval=0.01, max_retries=1)
+    w.close()  # หยุด thread เบื้องหลัง ให้ test เรียก _spill/_replay_journal เอง
+    return w
+
+
+def doc(name):
+    return {"_id": ObjectId(), "name": name}
+
+
+def saved_names(mongo):
+    return sorted(d["name"] for d in mongo["client"][app.CASE_DATABASE_NAME][COLLECTION].find())
+
+
+def journal_names(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        return sorted(json_util.loads(line)["document"]["name"] for line in f if line.strip())
+
+
+def write_journal(path, *documents):
+    with open(path, "a", encoding="utf-8") as f:
+        for d in documents:
+            f.write(json_util.dumps({"collection": COLLECTION, "document": d}) + "\n")
+
+
+def test_spill_then_replay_with_mongo_down_keeps_documents(writer, mongo):
+    documents = [doc("a"), doc("b"), doc("c")]
+    writer._spill([(COLLECTION, d) for d in documents])
+    assert writer.status(str(documents[0]["_id"])) == writer.STATUS_JOURNALED
+
+    writer._replay_journal()
+
+    assert journal_names(writer.journal_path) == ["a", "b", "c"]
+    assert not os.path.exists(writer.journal_path + ".replay")
+    assert saved_names(mongo) == []
+
+
+def test_replay_inserts_journal_once_mongo_is_back(writer, mongo):
+    documents = [doc("a"), doc("b"), doc("c")]
+    writer._spill([(COLLECTION, d) for d in documents])
+    writer._replay_journal()
+
+    mongo["up"] = True
+    writer._replay_journal()
+
+    assert saved_names(mongo) == ["a", "b", "c"]
+    assert not os.path.exists(writer.journal_path)
+    assert not os.path.exists(writer.journal_path + ".replay")
+    assert writer.status(str(documents[2]["_id"])) == writer.STATUS_SAVED
+
+
+def test_stale_replay_file_is_not_overwritten(writer, mongo):
+    # process ตายหลัง rotate แต่ก่อนลบ .replay: รอบถัดไปต้องไม่ทับของเดิม
+    write_journal(writer.journal_path + ".replay", doc("a"))
+    write_journal(writer.journal_path, doc("b"))
+
+    writer._replay_journal()
+    assert journal_names(writer.journal_path) == ["a", "b"]
+
+    mongo["up"] = True
+    writer._replay_journal()
+    assert saved_names(mongo) == ["a", "b"]
+    assert not os.path.exists(writer.journal_path + ".replay")
+
+
+def test_replay_skips_malformed_lines(writer, mongo):
+    write_journal(writer.journal_path, doc("a"))
+    with open(writer.journal_path, "a", encoding="utf-8") as f:
+        f.write('{"collection": "practice_logs", "docu')  # บรรทัดที่เขียนไม่ครบ
+    mongo["up"] = True
+
+    writer._replay_journal()
+
+    assert saved_names(mongo) == ["a"]
+
+
+def test_unwritable_journal_keeps_documents_in_memory(tmp_path, mongo):
+    w = app.PracticeLogWriter(str(tmp_path / "missing" / "journal.jsonl"), batch_size=2,
+                              flush_interval=0.01, max_retries=1)
+    w.close()
+    documents = [doc("a"), doc("b"), doc("c")]
+    w._spill([(COLLECTION, d) for d in documents])
+    assert len(w._backlog) == 3
+
+    w._replay_journal()
+    assert len(w._backlog) == 3
+
+    mongo["up"] = True
+    w._replay_journal()
+    assert saved_names(mongo) == ["a", "b", "c"]
+    assert w._backlog == []
+
+
+def test_writer_thread_saves_submitted_documents(tmp_path, mongo):
+    mongo["up"] = True
+    w = app.PracticeLogWriter(str(tmp_path / "journal.jsonl"), batch_size=2, flush_interval=0.01, max_retries=1)
+    try:
+        log_id = w.submit(doc("a"), COLLECTION)
+        for _ in range(200):
+            if w.status(log_id) == w.STATUS_SAVED:
+                break
+            app.time.sleep(0.01)
+        assert w.status(log_id) == w.STATUS_SAVED
+    finally:
+        w.close()
+    assert saved_names(mongo) == ["a"]